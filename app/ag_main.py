@@ -1,36 +1,26 @@
 import os
-from langgraph.prebuilt import create_react_agent
-from langchain_mcp_adapters.client import MultiServerMCPClient
+import json
+import asyncio
+from typing import Any
+from contextlib import asynccontextmanager
 from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import AnyMessage, HumanMessage
 from dotenv import load_dotenv
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-import aiosqlite
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
 from datetime import datetime, timedelta, timezone
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from agent_registry import AgentRegistry
+from intent_router import FastPathRouter
+from query_cache import normalize_query
+from session_gate import SessionGate
 
 load_dotenv()
 
 RAG_AG_URL = os.getenv("RAG_AG_URL")
 REP_AG_URL = os.getenv("REP_AG_URL")
 
-app = FastAPI(
-    title="Main Agent"
-)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8080", "http://localhost"], 
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
 @tool
 def get_current_time_in_taiwan() -> str:
     """Gets the current time in Taiwan time zone (Asia/Taipei, UTC+8)"""
@@ -38,36 +28,8 @@ def get_current_time_in_taiwan() -> str:
     current_time = datetime.now(tz)
     return current_time.strftime("%Y-%m-%d %H:%M:%S %Z")
 
-@app.post("/run_agent")
-async def run_agent(model: str = "gpt-4.1-mini", user_query: str = "", session_id: str = "default_session") -> str:
-
-    #Initializing client for our two mcp agents through SSE connection
-    client = MultiServerMCPClient(
-        {
-            "rag_ag": {
-                "url": f"{RAG_AG_URL}/sse",
-                "transport": "sse"
-            },
-            "rep_ag": {
-                "url": f"{REP_AG_URL}/sse",
-                "transport": "sse"
-            }
-        }
-    )
-    #Now fetching two our MCP tools
-    tools = await client.get_tools()
-    tools.append(get_current_time_in_taiwan) #Adding the custom tool to get current time in Taiwan
-
-    #Now initializing connection with db, that will be used to store checkpoints to keep conversation memory
-
-    async_conn = await aiosqlite.connect("checkpoints_agent.db")
-    checkpointer = AsyncSqliteSaver(async_conn)
-
-    #Now initializing LLM model that will be used for our agent
-    llm = ChatOpenAI(model=model)
-
-    #Creating system message
-    system_message = """
+#Creating system message for the coordinator agent
+SYSTEM_MESSAGE = """
 You are a coordinator agent for managing customer return orders and warranties. 
 You have access to tools from 'rag_ag' for retrieving data or inserting new returns, 
 and from 'rep_ag' for generating Excel reports based on retrieved data.
@@ -75,15 +37,17 @@ Use 'get_current_time_in_taiwan' for any time-related queries (e.g., filtering b
 
 Delegate based on the user query:
 - For retrieving returns (e.g., 'list defective headphones') or inserting new ones (e.g., 'add return for order 1101'), use rag_ag tools.
-- For generating reports (e.g., 'create a report on all returns'), first retrieve the necessary data using rag_ag tools, then pass the retrieved data string directly to rep_ag's generate_excel_report tool.
+- For generating reports (e.g., 'create a report on all returns'), call rep_ag directly and describe which returns to report on; rep_ag reads the rows from the database itself.
 - Always include relevant dates in Taiwan time if time-sensitive.
 - Respond with the final result from the tools or a confirmation.
 
 When generating a report:
-1) Call rag_ag.return_all_data() for full reports OR rag_ag.retrieve_data(query=...) for filtered reports.
-2) Pass the returned string AS-IS to rep_ag.generate_excel_report(data=...).
-Do NOT reformat, summarize, number, convert to JSON/CSV, or alter the text in any way.
-If generate_excel_report fails, retry once with rag_ag.return_all_data() (AS-IS).
+1) Call rep_ag with the report filters in plain words (category, store, product, approval, return reason, date window as YYYY-MM-DD), 
+   e.g. "Generate a report for category Electronics from 2025-01-01 to 2025-01-31", or "Generate a report for all returns". 
+   If rag_ag already returned a 'Report dataset_id' for the rows the user means, pass "Generate a report for dataset_id ds_..." instead.
+2) Do NOT fetch the rows with rag_ag and copy them into the rep_ag query, the report rows must never pass through you.
+3) Reports are built in the background, rep_ag answers with a report job id and links. Pass the links to the user as they are; 
+   when the user asks whether a report is ready, ask rep_ag about that job id.
 
 You must not ask any confirmation questions to the user, but instead make your best guess based on the query and proceed with the appropriate tool calls.
 There are sample examples of conversations for your reference:
@@ -105,25 +69,83 @@ User: Thanks for the insights. Please generate an Excel report for me to downloa
 Assistant: Sure, please click here to download your Excel report.
 """
 
-    #Createing custom initial prompt for the agent
-    system_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_message),
-            MessagesPlaceholder("messages"),
-        ]
-    )
+#Added when the sub-agents run in flat tool mode (MCP_FLAT_TOOLS=1) and expose their data tools instead of run_rag_ag/run_rep_ag
+FLAT_TOOLS_MESSAGE = """
+The sub-agents expose their tools to you directly, so what is said above about rag_ag and rep_ag applies to these tools:
+- 'list_return_orders' for listing returns with exact filters (it also gives the Report dataset_id), 'retrieve_data' for free-text search,
+  'aggregate_returns' for counts, totals, averages and trends, 'insert_return' for a new return (all fields are needed), 
+  'return_all_data' only when every return order is really needed.
+- 'generate_report_from_query' for reports, with the filters or a dataset_id; 'generate_excel_report' only for data the user typed in; 
+  'get_report_job' when the user asks whether a report is ready.
+"""
 
-    #Now creating the agent itself with checkpointer and custom prompt
-    agent_executor = create_react_agent(
-        llm,
-        tools=tools,
-        prompt=system_prompt,
-        checkpointer=checkpointer
-    )
+def build_system_message(tool_names):
+    #The prompt follows the tools the sub-agents actually expose
+    if "list_return_orders" in tool_names or "generate_report_from_query" in tool_names:
+        return SYSTEM_MESSAGE + FLAT_TOOLS_MESSAGE
+    return SYSTEM_MESSAGE
+
+#Registry that keeps the MCP tools, checkpointer and compiled coordinator graphs for the lifetime of the service
+registry = AgentRegistry(
+    build_system_message,
+    tools=[get_current_time_in_taiwan], #Adding the custom tool to get current time in Taiwan
+    mcp_servers={
+        "rag_ag": RAG_AG_URL,
+        "rep_ag": REP_AG_URL,
+    },
+)
+
+#Common intents (full report, listing, inserting, time) are answered with one tool call instead of the ReAct loop
+router = FastPathRouter(lambda: registry.tools)
+
+#Runs of one session are serialized, identical messages sent while one is running share its answer
+gate = SessionGate()
+
+def _request_key(model: str, user_query: str, session_id: str):
+    return (session_id, model, normalize_query(user_query))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await registry.start()
+    yield
+    await registry.close()
+
+app = FastAPI(
+    title="Main Agent",
+    lifespan=lifespan
+)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:8080", "http://localhost"], 
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.post("/run_agent")
+async def run_agent(model: str = "gpt-4.1-mini", user_query: str = "", session_id: str = "default_session") -> str:
+    return await gate.run(session_id, _request_key(model, user_query, session_id), lambda: _run_agent(model, user_query, session_id))
+
+async def _run_agent(model: str, user_query: str, session_id: str) -> str:
+
+    #Getting the coordinator agent for the model, it is only compiled on the first request for that model
+    agent_executor = await registry.get_agent(model)
 
     #Creating config to keep tracking of all the states in the ag conversation history with checkpointers
     config = RunnableConfig(configurable={"thread_id": session_id}, recursion_limit=70)
 
+    #Trying the fast path first, the agent only runs when the router does not recognize the message
+    planned = router.plan(user_query, session_id)
+    if planned:
+        intent, fast_tool, tool_args = planned
+        try:
+            answer = router.answer(intent, _chunk_text(await fast_tool.ainvoke(tool_args)))
+            await router.record(agent_executor, config, user_query, answer)
+            return answer
+        except Exception as e:
+            print(f"Fast path for '{intent}' failed, falling back to the agent: {e}")
+
     #Formating the user input to match the checkpointer schema
     input_data = {"messages": [HumanMessage(content=user_query)]}
 
@@ -133,20 +155,90 @@ Assistant: Sure, please click here to download your Excel report.
     print("Agent execution completed")
 
     #And finally retrieve the final state from the checkpointer to extract the agent's output
-    checkpoint = await checkpointer.aget(config)
-    final_output_text = ""
-    if checkpoint:
-        state = checkpoint["channel_values"]
-        messages = state.get("messages", [])
-        for message in reversed(messages):
-            if getattr(message, "type", "") == "ai" and not getattr(message, "tool_calls", []): #Ensuring we get the final agent message, but not a tool call
-                raw_content = getattr(message, "content", "")
-                final_output_text = raw_content
-                break
-    else:
-        print("No checkpoint found for final state")
-
-    return final_output_text if final_output_text else "No output generated"
-
-
-    
\ No newline at end of file
+    return await registry.final_output(config)
+
+
+#Turning the content of a streamed message chunk into plain text
+def _chunk_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(item.get("text", "") if isinstance(item, dict) else str(item) for item in content)
+    return str(content)
+
+#Tool inputs and outputs can be huge (full datasets), so we only send a short preview of them to the client
+def _preview(value: Any, limit: int = 500) -> str:
+    text = _chunk_text(getattr(value, "content", value))
+    return text if len(text) <= limit else text[:limit] + "..."
+
+@app.post("/run_agent/stream")
+async def run_agent_stream(model: str = "gpt-4.1-mini", user_query: str = "", session_id: str = "default_session"):
+    """Runs the agent like /run_agent, but streams tokens, tool steps and the final answer as NDJSON events."""
+
+    agent_executor = await registry.get_agent(model)
+    config = RunnableConfig(configurable={"thread_id": session_id}, recursion_limit=70)
+    input_data = {"messages": [HumanMessage(content=user_query)]}
+
+    planned = router.plan(user_query, session_id)
+    key = _request_key(model, user_query, session_id)
+
+    async def run_events(result):
+        try:
+            if planned:
+                intent, fast_tool, tool_args = planned
+                yield json.dumps({"type": "tool_start", "name": fast_tool.name, "input": _preview(tool_args)}) + "\n"
+                try:
+                    output = _chunk_text(await fast_tool.ainvoke(tool_args))
+                    yield json.dumps({"type": "tool_end", "name": fast_tool.name, "output": _preview(output)}) + "\n"
+                    answer = router.answer(intent, output)
+                    await router.record(agent_executor, config, user_query, answer)
+                    result.set_result(answer)
+                    yield json.dumps({"type": "final", "content": answer}) + "\n"
+                    return
+                except Exception as e:
+                    print(f"Fast path for '{intent}' failed, falling back to the agent: {e}")
+
+            async for event in agent_executor.astream_events(input_data, config=config, version="v2"):
+                kind = event["event"]
+                if kind == "on_chat_model_stream":
+                    text = _chunk_text(event["data"]["chunk"].content)
+                    if text:
+                        yield json.dumps({"type": "token", "content": text}) + "\n"
+                elif kind == "on_tool_start":
+                    yield json.dumps({"type": "tool_start", "name": event["name"], "input": _preview(event["data"].get("input"))}) + "\n"
+                elif kind == "on_tool_end":
+                    yield json.dumps({"type": "tool_end", "name": event["name"], "output": _preview(event["data"].get("output"))}) + "\n"
+            print("Agent execution completed")
+
+            #The final answer is read back from the checkpointer, same as in /run_agent
+            answer = await registry.final_output(config)
+            result.set_result(answer)
+            yield json.dumps({"type": "final", "content": answer}) + "\n"
+        except Exception as e:
+            if not result.done():
+                result.set_exception(e)
+            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+
+    async def events():
+        #The same message of this session is already queued or running, its answer is sent without a second run
+        pending = gate.inflight(key)
+        if pending is not None:
+            try:
+                yield json.dumps({"type": "final", "content": await asyncio.shield(pending)}) + "\n"
+            except Exception as e:
+                yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+            return
+        #Holding the session lock for the whole stream, the next message of the session starts after this one
+        async with gate.lead(session_id, key) as result:
+            async for line in run_events(result):
+                yield line
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/stats")
+async def stats():
+    return {"sessions": gate.stats()}
@@ -0,0 +1,171 @@
+import os
+import asyncio
+import httpx
+from typing import Any, Callable, Dict, List, Optional, Union
+from langgraph.prebuilt import create_react_agent
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from checkpoint_store import CHECKPOINT_DB, CheckpointStore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#How often (in seconds) we check the MCP sub-agents for a restart
+MCP_WATCH_INTERVAL = float(os.getenv("MCP_WATCH_INTERVAL", "15"))
+#With MCP_FLAT_TOOLS=1 the sub-agents expose their data tools over MCP instead of a nested agent tool
+MCP_FLAT_TOOLS = os.getenv("MCP_FLAT_TOOLS", "0") not in ("0", "false", "False", "")
+
+
+def add_flat_tools(mcp: Any, tools: List[Any]) -> None:
+    """Registers LangChain tools directly on a FastMCP server, with their own names and descriptions."""
+    for t in tools:
+        mcp.add_tool(t.coroutine, name=t.name, description=t.description)
+
+
+class AgentRegistry:
+    """Builds the agent graph of a service once per model and shares it across requests.
+
+    The registry owns everything that used to be created on every request: the checkpoint
+    store, the MCP tool list, the LLM clients and the compiled graphs. It is started and
+    closed from the FastAPI lifespan of the service.
+    """
+
+    def __init__(
+        self,
+        system_message: Union[str, Callable[[List[str]], str]],
+        tools: Optional[List[Any]] = None,
+        mcp_servers: Optional[Dict[str, str]] = None,
+        llm_kwargs: Optional[Dict[str, Any]] = None,
+        checkpoint_url: str = CHECKPOINT_DB,
+    ):
+        self.system_message = system_message
+        self.local_tools = list(tools or [])
+        self.mcp_servers = {name: url for name, url in (mcp_servers or {}).items() if url}
+        self.llm_kwargs = llm_kwargs or {}
+        self.checkpoint_store = CheckpointStore(checkpoint_url)
+        self.checkpointer: Optional[BaseCheckpointSaver] = None
+        self._mcp_tools: List[Any] = []
+        self._agents: Dict[str, Any] = {}
+        self._lock = asyncio.Lock()
+        self._instance_ids: Dict[str, Optional[str]] = {}
+        self._watcher: Optional[asyncio.Task] = None
+
+    @property
+    def tools(self) -> List[Any]:
+        return self._mcp_tools + self.local_tools
+
+    def _prompt(self) -> ChatPromptTemplate:
+        #The system message may be built from the names of the loaded tools, e.g. flat MCP tools instead of sub-agents
+        system_message = self.system_message
+        if callable(system_message):
+            system_message = system_message([t.name for t in self.tools])
+        return ChatPromptTemplate.from_messages(
+            [
+                ("system", system_message),
+                MessagesPlaceholder("messages"),
+            ]
+        )
+
+    async def start(self) -> None:
+        #Opening the checkpoint connection pool once for the whole lifetime of the service
+        self.checkpointer = await self.checkpoint_store.open()
+
+        if self.mcp_servers:
+            try:
+                await self.refresh_tools()
+            except Exception as e: #The sub-agents may still be starting, the watcher will pick them up later
+                print(f"Could not load MCP tools at startup: {e}")
+            self._watcher = asyncio.create_task(self._watch_servers())
+
+    async def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        self._agents.clear()
+        await self.checkpoint_store.close()
+        self.checkpointer = None
+
+    async def refresh_tools(self) -> None:
+        """Re-fetches the MCP tool list and drops the compiled graphs so they get rebuilt with it."""
+        client = MultiServerMCPClient(
+            {
+                name: {
+                    "url": f"{url}/sse",
+                    "transport": "sse"
+                }
+                for name, url in self.mcp_servers.items()
+            }
+        )
+        tools = await client.get_tools()
+        async with self._lock:
+            self._mcp_tools = tools
+            self._agents.clear()
+        print(f"Loaded {len(tools)} MCP tools: {[t.name for t in tools]}")
+
+    async def get_agent(self, model: str) -> Any:
+        agent = self._agents.get(model)
+        if agent is not None:
+            return agent
+
+        #If the sub-agents were not reachable before, trying once more before building the graph without them
+        if self.mcp_servers and not self._mcp_tools:
+            try:
+                await self.refresh_tools()
+            except Exception as e:
+                print(f"MCP tools are still unavailable: {e}")
+
+        async with self._lock:
+            agent = self._agents.get(model)
+            if agent is None:
+                agent = create_react_agent(
+                    ChatOpenAI(model=model, **self.llm_kwargs),
+                    tools=self.tools,
+                    prompt=self._prompt(),
+                    checkpointer=self.checkpointer
+                )
+                self._agents[model] = agent
+        return agent
+
+    async def final_output(self, config: RunnableConfig) -> str:
+        """Reads the final agent message (not a tool call) of the thread back from the checkpointer."""
+        checkpoint = await self.checkpointer.aget(config)
+        final_output_text = ""
+        if checkpoint:
+            state = checkpoint["channel_values"]
+            messages = state.get("messages", [])
+            for message in reversed(messages):
+                if getattr(message, "type", "") == "ai" and not getattr(message, "tool_calls", []): #Ensuring we get the final agent message, but not a tool call
+                    final_output_text = getattr(message, "content", "")
+                    break
+        else:
+            print("No checkpoint found for final state")
+
+        return final_output_text if final_output_text else "No output generated"
+
+    async def _watch_servers(self) -> None:
+        #Every sub-agent reports a random instance id on /ping, a new id (or coming back after being down) means it restarted
+        async with httpx.AsyncClient(timeout=5) as http:
+            while True:
+                await asyncio.sleep(MCP_WATCH_INTERVAL)
+                changed = False
+                for name, url in self.mcp_servers.items():
+                    try:
+                        response = await http.get(f"{url}/ping")
+                        instance_id = response.json().get("instance_id")
+                    except Exception:
+                        instance_id = None
+                    if name in self._instance_ids and instance_id != self._instance_ids[name] and instance_id is not None:
+                        changed = True
+                    self._instance_ids[name] = instance_id
+                if changed or (not self._mcp_tools and all(self._instance_ids.values())):
+                    try:
+                        await self.refresh_tools()
+                    except Exception as e:
+                        print(f"Could not refresh MCP tools: {e}")
@@ -0,0 +1,134 @@
+import os
+import asyncio
+import aiosqlite
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Either a path to a SQLite file or a postgresql:// URL of a local server-backed store
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints_agent.db")
+CHECKPOINT_POOL_SIZE = int(os.getenv("CHECKPOINT_POOL_SIZE", "4"))
+CHECKPOINT_BUSY_TIMEOUT_MS = int(os.getenv("CHECKPOINT_BUSY_TIMEOUT_MS", "5000"))
+
+
+async def open_sqlite_connection(path: str) -> aiosqlite.Connection:
+    """Opens a SQLite connection tuned for concurrent writers (WAL, synchronous=NORMAL, busy timeout)."""
+    conn = await aiosqlite.connect(path, timeout=CHECKPOINT_BUSY_TIMEOUT_MS / 1000)
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute(f"PRAGMA busy_timeout={CHECKPOINT_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+class PooledSqliteSaver(BaseCheckpointSaver):
+    """Checkpoint saver that spreads the work over a bounded pool of SQLite connections.
+
+    AsyncSqliteSaver serializes everything on a single connection, so here every pooled
+    connection gets its own saver and each call borrows one of them for its duration.
+    """
+
+    def __init__(self, path: str, size: int = CHECKPOINT_POOL_SIZE):
+        super().__init__()
+        self.path = path
+        self.size = max(1, size)
+        self._savers: List[AsyncSqliteSaver] = []
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    async def open(self) -> None:
+        for _ in range(self.size):
+            saver = AsyncSqliteSaver(await open_sqlite_connection(self.path))
+            self._savers.append(saver)
+            self._idle.put_nowait(saver)
+        #Creating the tables once, the other savers only need to know that it is done
+        await self._savers[0].setup()
+        for saver in self._savers[1:]:
+            saver.is_setup = True
+
+    async def close(self) -> None:
+        for saver in self._savers:
+            await saver.conn.close()
+        self._savers.clear()
+        self._idle = asyncio.Queue()
+
+    @asynccontextmanager
+    async def _saver(self) -> AsyncIterator[AsyncSqliteSaver]:
+        saver = await self._idle.get()
+        try:
+            yield saver
+        finally:
+            self._idle.put_nowait(saver)
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        async with self._saver() as saver:
+            return await saver.aget_tuple(config)
+
+    async def alist(self, config: Optional[RunnableConfig], **kwargs: Any) -> AsyncIterator[CheckpointTuple]:
+        #Collecting the items first, so the connection is not held while the caller iterates
+        async with self._saver() as saver:
+            items = [item async for item in saver.alist(config, **kwargs)]
+        for item in items:
+            yield item
+
+    async def aput(self, config: RunnableConfig, *args: Any, **kwargs: Any) -> RunnableConfig:
+        async with self._saver() as saver:
+            return await saver.aput(config, *args, **kwargs)
+
+    async def aput_writes(self, config: RunnableConfig, *args: Any, **kwargs: Any) -> None:
+        async with self._saver() as saver:
+            await saver.aput_writes(config, *args, **kwargs)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        async with self._saver() as saver:
+            await saver.adelete_thread(thread_id)
+
+    def get_next_version(self, current: Any, channel: Any) -> Any:
+        return AsyncSqliteSaver.get_next_version(self, current, channel)
+
+
+class CheckpointStore:
+    """Owns the checkpoint saver of a service and its connections, from the lifespan startup to shutdown."""
+
+    def __init__(self, url: str = CHECKPOINT_DB, pool_size: int = CHECKPOINT_POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self.saver: Optional[BaseCheckpointSaver] = None
+        self._pg_pool: Any = None
+
+    async def open(self) -> BaseCheckpointSaver:
+        if self.url.startswith(("postgres://", "postgresql://")):
+            #The server-backed store is optional, so its packages are only needed when it is configured
+            try:
+                from psycopg.rows import dict_row
+                from psycopg_pool import AsyncConnectionPool
+                from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+            except ImportError as e:
+                raise RuntimeError(
+                    "CHECKPOINT_DB points at Postgres, install langgraph-checkpoint-postgres and psycopg[pool] to use it"
+                ) from e
+            self._pg_pool = AsyncConnectionPool(
+                self.url,
+                min_size=1,
+                max_size=self.pool_size,
+                kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+                open=False,
+            )
+            await self._pg_pool.open()
+            self.saver = AsyncPostgresSaver(self._pg_pool)
+            await self.saver.setup()
+        else:
+            self.saver = PooledSqliteSaver(self.url, self.pool_size)
+            await self.saver.open()
+        return self.saver
+
+    async def close(self) -> None:
+        if isinstance(self.saver, PooledSqliteSaver):
+            await self.saver.close()
+        if self._pg_pool is not None:
+            await self._pg_pool.close()
+            self._pg_pool = None
+        self.saver = None
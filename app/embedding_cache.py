@@ -0,0 +1,173 @@
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Any, Dict, List, Optional
+from langchain_core.embeddings import Embeddings
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+#Cache hits are only written back as last_used in batches of this size (or with the next store)
+TOUCH_BATCH_SIZE = 256
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper with a disk-backed LRU cache keyed on (model, text hash).
+
+    Documents and queries share the same cache, so bulk loads, single inserts and repeated
+    analyst queries only pay the embedding API for texts it has never seen.
+    """
+
+    def __init__(self, underlying: Embeddings, path: str = EMBEDDING_CACHE_PATH,
+                 max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, model: Optional[str] = None):
+        self.underlying = underlying
+        self.model = model or getattr(underlying, "model", None) or type(underlying).__name__
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+
+        #Chroma calls the embeddings from worker threads, so one connection is shared under the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (model, text_hash)
+            )
+            ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, hashes: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[text_hash] = vector.tolist()
+            #Remembering the entries we used, so the eviction drops the least recently used ones.
+            #They are written together later instead of a commit on every hit
+            now = time.time()
+            self._touched.update((text_hash, now) for text_hash in found)
+            if len(self._touched) >= TOUCH_BATCH_SIZE:
+                self._flush_touched()
+                self._conn.commit()
+        return found
+
+    def _flush_touched(self) -> None:
+        #Called with the lock held, the caller commits
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(used, self.model, text_hash) for text_hash, used in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _store(self, vectors: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            #Pending hits first, so the eviction below sees them as recently used
+            self._flush_touched()
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.model, text_hash, array("f", vector).tobytes(), now) for text_hash, vector in vectors.items()],
+            )
+            self._size += self._conn.total_changes - before
+            if self._size > self.max_entries:
+                overflow = self._size - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self._size -= overflow
+            self._conn.commit()
+
+    def _split(self, texts: List[str]):
+        hashes = [self._hash(text) for text in texts]
+        cached = self._lookup(hashes)
+        #Only embedding each missing text once, even if it appears several times in the batch
+        missing: Dict[str, str] = {}
+        miss_count = 0
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached:
+                missing.setdefault(text_hash, text)
+                miss_count += 1
+        self.hits += len(texts) - miss_count
+        self.misses += miss_count
+        return hashes, cached, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, cached, missing = self._split(texts)
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self._store(new)
+            cached.update(new)
+        return [cached[text_hash] for text_hash in hashes]
+
+    #The async variants do their SQLite work in a thread, so the event loop never waits on the disk
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, cached, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            vectors = await self.underlying.aembed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self._store, new)
+            cached.update(new)
+        return [cached[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        hashes, cached, missing = self._split([text])
+        if missing:
+            cached[hashes[0]] = self.underlying.embed_query(text)
+            self._store({hashes[0]: cached[hashes[0]]})
+        return cached[hashes[0]]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        hashes, cached, missing = await asyncio.to_thread(self._split, [text])
+        if missing:
+            cached[hashes[0]] = await self.underlying.aembed_query(text)
+            await asyncio.to_thread(self._store, {hashes[0]: cached[hashes[0]]})
+        return cached[hashes[0]]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model,
+            "entries": self._size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,153 @@
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Set FAST_PATH_ROUTER=0 to send every message through the coordinator agent
+FAST_PATH_ROUTER = os.getenv("FAST_PATH_ROUTER", "1") not in ("0", "false", "False", "")
+
+#Only whole messages are matched, anything with more to it than the intent itself goes to the agent
+TIME_PATTERNS = [
+    re.compile(r"^(what('s|\s+is)?\s+)?(the\s+)?(current\s+)?(time|date)(\s+(is\s+it|now|today))*(\s+in\s+taiwan)?\s*\??$", re.I),
+    re.compile(r"^what\s+(day|date)\s+is\s+(it|today)(\s+in\s+taiwan)?\s*\??$", re.I),
+]
+FULL_REPORT_PATTERN = re.compile(
+    r"^(please\s+)?((can|could)\s+you\s+)?(generate|create|make|build|give|i\s+want|i'?d\s+like)(\s+me)?\s+"
+    r"(an?\s+|the\s+)?(full\s+|complete\s+)?(excel\s+)?report\s+(of|on|for|with)\s+(all|every)(\s+the)?\s+returns?(\s+orders?)?"
+    r"(\s+please)?\s*[.!?]?$",
+    re.I,
+)
+LIST_PATTERN = re.compile(
+    r"^(please\s+)?(list|show)(\s+me)?(\s+all)?(\s+the)?\s+returns?(\s+orders?)?\s+(for|of|in|with|from)\s+(the\s+)?"
+    r"(?P<field>category|product|store)\s+['\"]?(?P<value>[^'\"]+?)['\"]?\s*[.!]?$",
+    re.I,
+)
+#A value holding one of these words carries more request than a plain name ("iPhone 15 from last week"), the agent handles those
+CLAUSE_WORDS = re.compile(
+    r"\b(and|or|but|from|since|until|before|after|between|during|last|past|this|next|in|on|at|with|without|where|which|that|"
+    r"who|why|how|what|when|whose|than|by|per|tell|show|give|explain|please|also|then|only|not)\b",
+    re.I,
+)
+#Answers of the data tools that mean the fast path did not find what the user asked for
+UNUSABLE_OUTPUT = re.compile(r"^\s*(error\b|no return orders)", re.I)
+INSERT_PATTERN = re.compile(r"^(please\s+)?(add|insert|create|record|register)\s+(a\s+)?(new\s+)?return\b", re.I)
+#"key: value" or "key = value" pairs of an insert request, with the same synonyms the report agent accepts.
+#A comma only ends a value when the next key follows it, so "cost: 3,300" keeps its thousands separator
+FIELD_KEYS = r"(order[ _]?id|product|category|return[ _]reason|reason|cost|price|approved(?:[ _]flag)?|store(?:[ _]name)?|date)"
+FIELD_PATTERN = re.compile(
+    FIELD_KEYS + r"\s*[:=]\s*((?:(?!,\s*" + FIELD_KEYS + r"\s*[:=])[^;\n])+)",
+    re.I,
+)
+#A whole amount, optionally with a currency sign and thousands separators ("$3,300.50")
+COST_PATTERN = re.compile(r"^\$?\s*(\d{1,3}(?:,\d{3})+|\d+)(\.\d+)?$")
+FIELD_NAMES = {
+    "orderid": "order_id",
+    "reason": "return_reason",
+    "price": "cost",
+    "approved": "approved_flag",
+    "store": "store_name",
+}
+INSERT_FIELDS = ("order_id", "product", "category", "return_reason", "cost", "approved_flag", "store_name", "date")
+
+
+def _field_name(key: str) -> str:
+    key = re.sub(r"[ _]+", "_", key.strip().lower())
+    return FIELD_NAMES.get(key.replace("_", ""), FIELD_NAMES.get(key, key))
+
+def classify(text: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Returns (intent, arguments) for the messages the router can answer without the agent, or None."""
+    text = text.strip()
+    if not text:
+        return None
+    if any(pattern.match(text) for pattern in TIME_PATTERNS):
+        return "time", {}
+    if FULL_REPORT_PATTERN.match(text):
+        return "full_report", {}
+    match = LIST_PATTERN.match(text)
+    if match and not CLAUSE_WORDS.search(match.group("value")):
+        field = "store_name" if match.group("field").lower() == "store" else match.group("field").lower()
+        return "list", {field: match.group("value").strip()}
+    if INSERT_PATTERN.match(text):
+        fields = {_field_name(match.group(1)): match.group(2).strip().rstrip(",").strip() for match in FIELD_PATTERN.finditer(text)}
+        #Without every field the agent has to ask for the missing ones, like in the conversation examples
+        if all(fields.get(name) for name in INSERT_FIELDS):
+            return "insert", {name: fields[name] for name in INSERT_FIELDS}
+    return None
+
+
+class FastPathRouter:
+    """Answers the most common intents with a single tool call instead of a coordinator ReAct loop.
+
+    Data tools exposed directly by the sub-agents are called when they are available, otherwise
+    the request is handed to the sub-agent in one hop. The exchange is written to the coordinator's
+    checkpoint thread, so the agent still sees it in the following turns.
+    """
+
+    def __init__(self, tools_getter, enabled: bool = FAST_PATH_ROUTER):
+        self._tools_getter = tools_getter
+        self.enabled = enabled
+
+    def _tools(self) -> Dict[str, Any]:
+        return {t.name: t for t in self._tools_getter()}
+
+    def plan(self, text: str, session_id: str) -> Optional[Tuple[str, Any, Dict[str, Any]]]:
+        """Returns the intent, the tool and the arguments to answer the message with, or None to use the agent."""
+        if not self.enabled:
+            return None
+        intent = classify(text)
+        if intent is None:
+            return None
+        name, args = intent
+        tools = self._tools()
+
+        if name == "time":
+            candidates: List[Tuple[str, Dict[str, Any]]] = [("get_current_time_in_taiwan", {})]
+        elif name == "full_report":
+            candidates = [
+                ("generate_report_from_query", {}),
+                ("run_rep_ag", {"query": "Generate a report for all returns", "session_id": session_id}),
+            ]
+        elif name == "list":
+            field, value = next(iter(args.items()))
+            candidates = [
+                ("list_return_orders", args),
+                ("run_rag_ag", {"query": f"List the return orders with {field} {value}", "session_id": session_id}),
+            ]
+        else:
+            #A cost that is not a plain amount was probably read wrong, the agent asks instead of guessing
+            cost = _parse_cost(args["cost"])
+            if cost is None:
+                return None
+            candidates = [
+                ("insert_return", {**args, "cost": cost}),
+                ("run_rag_ag", {"query": text, "session_id": session_id}),
+            ]
+
+        for tool_name, tool_args in candidates:
+            if tool_name in tools and tool_args is not None:
+                return name, tools[tool_name], tool_args
+        return None
+
+    def answer(self, intent: str, output: str) -> str:
+        """Turns the tool output into the reply, raises ValueError when the agent should answer instead."""
+        #An empty result or an error usually means the message was read too literally, the agent can do better
+        if UNUSABLE_OUTPUT.match(output):
+            raise ValueError(output.strip()[:200])
+        if intent == "time":
+            return f"The current time in Taiwan is {output}."
+        return output
+
+    async def record(self, agent: Any, config: RunnableConfig, user_query: str, answer: str) -> None:
+        #Adding the exchange as if the agent had answered it, the next turn then starts from it
+        await agent.aupdate_state(config, {"messages": [HumanMessage(content=user_query), AIMessage(content=answer)]}, as_node="agent")
+
+
+def _parse_cost(value: str) -> Optional[float]:
+    match = COST_PATTERN.match(value.strip())
+    if not match:
+        return None
+    return float(match.group(1).replace(",", "") + (match.group(2) or ""))
@@ -0,0 +1,179 @@
+import re
+import time
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+#Dates are stored as ISO YYYY-MM-DD text, which sorts and compares the same way as the dates themselves
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d", "%m/%d/%Y", "%d %b %Y", "%d %B %Y", "%b %d, %Y", "%B %d, %Y")
+
+def normalize_date(value: str) -> str:
+    """Turns the date formats we get from files and messages into YYYY-MM-DD, raises ValueError for anything else."""
+    text = str(value).strip()
+    #Timestamps keep only their date part
+    match = re.match(r"^(\d{4}-\d{2}-\d{2})[T ]", text)
+    if match:
+        text = match.group(1)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognized date '{value}', use YYYY-MM-DD")
+
+
+#Columns of the keyword index, cost is left out as numbers are only matched as order ids
+FTS_COLUMNS = ("order_id", "product", "category", "return_reason", "approved_flag", "store_name", "date")
+
+def _fts_triggers() -> List[str]:
+    columns = ", ".join(FTS_COLUMNS)
+    new_values = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_values = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS return_orders_fts_insert AFTER INSERT ON return_orders BEGIN
+            INSERT INTO return_orders_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS return_orders_fts_delete AFTER DELETE ON return_orders BEGIN
+            INSERT INTO return_orders_fts(return_orders_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS return_orders_fts_update AFTER UPDATE ON return_orders BEGIN
+            INSERT INTO return_orders_fts(return_orders_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO return_orders_fts(rowid, {columns}) VALUES (new.rowid, {new_values});
+            END""",
+    ]
+
+
+#Every migration runs once, in its own transaction. The first ones use IF NOT EXISTS, so databases
+#created before this framework are taken over without touching their data
+def _initial_schema(conn: sqlite3.Connection) -> None:
+    #Now creating the table to store the data from the CSV you provided me with
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS return_orders (
+        order_id TEXT PRIMARY KEY,
+        product TEXT,
+        category TEXT,
+        return_reason TEXT,
+        cost REAL,
+        approved_flag TEXT,
+        store_name TEXT,
+        date TEXT
+        )
+        ''')
+    #And a table that remembers which version of the seed file was loaded last
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS seed_state (
+        source TEXT PRIMARY KEY,
+        sha256 TEXT,
+        mtime REAL,
+        size INTEGER
+        )
+        ''')
+    #Saved query specs, so reports can be requested by a short dataset id instead of the rows themselves
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS datasets (
+        dataset_id TEXT PRIMARY KEY,
+        spec TEXT,
+        created_at REAL
+        )
+        ''')
+
+def _keyword_index(conn: sqlite3.Connection) -> None:
+    #Keyword index over the text columns, the triggers keep it in sync with every insert, update and delete
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS return_orders_fts USING fts5(
+        {", ".join(FTS_COLUMNS)}, content='return_orders', content_rowid='rowid'
+        )
+        ''')
+    for statement in _fts_triggers():
+        conn.execute(statement)
+    conn.execute("INSERT INTO return_orders_fts(return_orders_fts) VALUES ('rebuild')")
+
+def _index_outbox(conn: sqlite3.Connection) -> None:
+    #Change log of the inserted rows that still have to be embedded into the vector store
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS index_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id TEXT NOT NULL,
+        source TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL,
+        next_attempt_at REAL,
+        done_at REAL
+        )
+        ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS index_outbox_pending ON index_outbox (done_at, next_attempt_at)")
+
+def _normalize_dates(conn: sqlite3.Connection) -> None:
+    #Rewriting every date as YYYY-MM-DD, the update trigger refreshes the keyword index of the changed rows
+    updates, unparsed = [], 0
+    for order_id, date in conn.execute("SELECT order_id, date FROM return_orders WHERE date IS NOT NULL"):
+        try:
+            normalized = normalize_date(date)
+        except ValueError:
+            unparsed += 1
+            continue
+        if normalized != date:
+            updates.append((normalized, order_id))
+    conn.executemany("UPDATE return_orders SET date = ? WHERE order_id = ?", updates)
+    print(f"Normalized {len(updates)} dates, {unparsed} could not be parsed and were left as they are")
+
+def _filter_indexes(conn: sqlite3.Connection) -> None:
+    #Date windows, per category/store windows and product lookups become index range scans
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_date ON return_orders (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_category_date ON return_orders (category, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_store_date ON return_orders (store_name, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_product ON return_orders (product)")
+    conn.execute("ANALYZE")
+
+def _nocase_filter_indexes(conn: sqlite3.Connection) -> None:
+    #Text filters compare case-insensitively, an index is only used when its collation matches the comparison
+    conn.execute("DROP INDEX IF EXISTS return_orders_category_date")
+    conn.execute("DROP INDEX IF EXISTS return_orders_store_date")
+    conn.execute("DROP INDEX IF EXISTS return_orders_product")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_category_date ON return_orders (category COLLATE NOCASE, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_store_date ON return_orders (store_name COLLATE NOCASE, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS return_orders_product ON return_orders (product COLLATE NOCASE)")
+    conn.execute("ANALYZE")
+
+#New migrations are appended with the next version number, applied ones are never changed
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "initial schema", _initial_schema),
+    (2, "keyword index", _keyword_index),
+    (3, "index outbox", _index_outbox),
+    (4, "normalize dates", _normalize_dates),
+    (5, "filter indexes", _filter_indexes),
+    (6, "case-insensitive filter indexes", _nocase_filter_indexes),
+]
+
+
+def migrate(path: str, target: Optional[int] = None) -> List[int]:
+    """Applies the migrations the database does not have yet (blocking, run it in a thread). Returns the applied versions."""
+    applied: List[int] = []
+    with closing(sqlite3.connect(path, isolation_level=None)) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at REAL
+            )
+            ''')
+        for version, name, step in MIGRATIONS:
+            if target is not None and version > target:
+                break
+            #Taking the write lock before checking, so two services starting together do not both run a migration
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                    conn.execute("COMMIT")
+                    continue
+                step(conn)
+                conn.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)", (version, name, time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+            print(f"Applied migration {version}: {name}")
+    return applied
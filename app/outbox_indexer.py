@@ -0,0 +1,95 @@
+import os
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from pydantic import ValidationError
+from returns_store import RETURN_COLUMNS, ReturnOrder, complete_outbox, pending_outbox, retry_outbox, stored_order
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Entries embedded per round and how long the indexer sleeps when the outbox is empty
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+
+class OutboxIndexer:
+    """Background task that embeds the rows of index_outbox into the vector store.
+
+    Inserts only commit the row and its outbox entry, the indexer drains the outbox in batches
+    and marks the entries done. A failed batch stays in the outbox and is retried with backoff,
+    so the vector store always catches up with the database.
+    """
+
+    def __init__(self, index_orders: Callable[[List[ReturnOrder], List[str]], Awaitable[None]],
+                 on_indexed: Optional[Callable[[], None]] = None, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.index_orders = index_orders
+        self.on_indexed = on_indexed
+        self.batch_size = batch_size
+        self.indexed = 0
+        self.failures = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self) -> None:
+        """Wakes the indexer up right after an insert instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    async def drain_once(self) -> int:
+        """Indexes one batch of due entries and returns how many entries it handled."""
+        entries = await pending_outbox(self.batch_size)
+        if not entries:
+            return 0
+        #Entries of rows that were deleted since have nothing left to index
+        orders, sources, ids = [], [], []
+        for entry in entries:
+            if entry[2] is not None:
+                #A row that cannot be read is retried on its own with backoff, it must not hold back the others
+                try:
+                    orders.append(stored_order(dict(zip(RETURN_COLUMNS, entry[2:]))))
+                except ValidationError as e:
+                    self.failures += 1
+                    print(f"Outbox entry {entry[0]} (order_id {entry[2]}) cannot be indexed, retrying later: {e.errors()[0]['msg']}")
+                    await retry_outbox([entry[0]], str(e))
+                    continue
+                sources.append(entry[1])
+            ids.append(entry[0])
+        try:
+            if orders:
+                await self.index_orders(orders, sources)
+        except Exception as e:
+            self.failures += 1
+            print(f"Outbox indexing failed for {len(ids)} entries, retrying later: {e}")
+            await retry_outbox(ids, str(e))
+            return 0
+        await complete_outbox(ids)
+        self.indexed += len(orders)
+        if orders and self.on_indexed is not None:
+            self.on_indexed()
+        return len(entries)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                handled = await self.drain_once()
+            except Exception as e:
+                print(f"Outbox indexer error: {e}")
+                handled = 0
+            if handled:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -0,0 +1,69 @@
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1024"))
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+
+class QueryCache:
+    """In-process LRU cache of retrieval results, keyed on the request and the version of the data.
+
+    Every write to the return orders bumps the version, so results computed before the write can
+    never be served after it. Keys are taken when a lookup starts, a search that finishes after a
+    write is stored under the old version and simply never hit.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES):
+        self.max_entries = max(0, max_entries)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Tuple[Hashable, ...], Any]" = OrderedDict()
+
+    def key(self, *parts: Hashable) -> Tuple[Hashable, ...]:
+        return (self.version, *parts)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[Any]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple[Hashable, ...], value: Any) -> None:
+        #Results of an older version are not worth a slot
+        if self.max_entries == 0 or key[0] != self.version:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def bump(self) -> int:
+        """Starts a new data version, every cached result becomes unreachable."""
+        self.version += 1
+        self.invalidations += 1
+        self._entries.clear()
+        return self.version
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -1,102 +1,253 @@
+import io
 import os
+import uuid
+import asyncio
+import json
+import hashlib
 import sqlite3
 import aiosqlite
-from langgraph.prebuilt import create_react_agent
-from langchain_mcp_adapters.client import MultiServerMCPClient
+from contextlib import asynccontextmanager
 from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import AnyMessage, HumanMessage
 from dotenv import load_dotenv
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-import aiosqlite
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
 from datetime import datetime, timedelta, timezone
-from langchain.document_loaders import CSVLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
-from pydantic import BaseModel, Field
-from langchain.schema import Document
+from typing import Any, Dict, List, Optional
+from langchain_openai import OpenAIEmbeddings
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
 import pandas
-from fastapi import FastAPI
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from pydantic import ValidationError
 from mcp.server.fastmcp import FastMCP
+from agent_registry import MCP_FLAT_TOOLS, AgentRegistry, add_flat_tools
+from embedding_cache import CachedEmbeddings
+from query_cache import QueryCache, normalize_query
+from returns_store import (RETURNS_DB, RETURN_COLUMNS, SEED_CSV, ReturnOrder, aggregate, dataset_id_for, fetch_orders, fetch_page, insert_orders,
+                           keyword_search, normalize_field, order_ids_in, outbox_stats, save_dataset, search_terms, setup_db, stored_order)
+from outbox_indexer import OutboxIndexer
+from record_batch import encode_batch
 
 mcp = FastMCP()
 
 
 load_dotenv()
 
-#Creating a model for parsging the data from CSV
-class ReturnOrder(BaseModel):
-    order_id: str = Field(...)
-    product: str = Field(...)
-    category: str = Field(...)
-    return_reason: str = Field(...)
-    cost: float = Field(...)
-    approved_flag: str = Field(...)
-    store_name: str = Field(...)
-    date: str = Field(...)
-
-#First loading our CSV file
-loader = CSVLoader(file_path="sample.csv", csv_args={'delimiter': ','})
-documents = loader.load()
-
-#Next we need to process the file in order to store it in the vectore db 
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100) #Creating the text splitter and setting the chunk size and overlap to make sure we do not loose any context
-chunks = text_splitter.split_documents(documents)#First we are splitting it into chunks
-embeddings = OpenAIEmbeddings() #I've chosen openai embedding model due to its good performance
-vectorstore = Chroma.from_documents(chunks, embeddings) #Now we are creating the vectore store and upload the processed chunks into it
-
-
+#The vector store is persisted on disk, so a restart only mounts the existing collection
+CHROMA_DIR = os.getenv("CHROMA_DIR", "./chroma_db")
 
+#I've chosen openai embedding model due to its good performance, every text goes through the disk cache first
+embeddings = CachedEmbeddings(OpenAIEmbeddings())
+vectorstore = Chroma(
+    collection_name="return_orders",
+    embedding_function=embeddings,
+    persist_directory=CHROMA_DIR,
+)
+#Results of retrieve_data, every write to the return orders bumps the data version of this cache
+query_cache = QueryCache()
+
+#Rendering a return order as the "key: value" text that we embed and show to the agent
+def _row_text(order: ReturnOrder) -> str:
+    return "\n".join([
+        f"order_id: {order.order_id}",
+        f"product: {order.product}",
+        f"category: {order.category}",
+        f"return_reason: {order.return_reason}",
+        f"cost: {order.cost}",
+        f"approved_flag: {order.approved_flag}",
+        f"store_name: {order.store_name}",
+        f"date: {order.date}"
+    ])
 
-async def setup_db():
-    #Creating connection with the sqlite db
-    async with aiosqlite.connect("customer-data.db") as conn:
-        cursor = await conn.cursor()
-
-        #Now creating the table to store the data from the CSV you provided me with
-        await cursor.execute('''
-            CREATE TABLE IF NOT EXISTS return_orders (
-            order_id TEXT PRIMARY KEY,
-            product TEXT,
-            category TEXT,
-            return_reason TEXT,
-            cost REAL,
-            approved_flag TEXT,
-            store_name TEXT,
-            date TEXT
-            )
-            ''')
-        await conn.commit()
-        #Now loading our CSV file and inserting the data into the table, by converting it into list of tuples, where a tuple corresponds to a row in the table
-        dataFrame = pandas.read_csv("sample.csv") 
-        data = dataFrame.to_records(index=False).tolist()
-        await cursor.executemany('''
-            INSERT OR REPLACE INTO return_orders (order_id, product, category, return_reason, cost, approved_flag, store_name, date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', data)
-        await conn.commit()
+#Dates are kept as YYYYMMDD integers in the metadata, so the vector store can compare them in range filters
+def _date_num(date: str) -> int:
+    return int(datetime.strptime(date.strip()[:10], "%Y-%m-%d").strftime("%Y%m%d"))
+
+#Text fields filtered on, Chroma compares strings case-sensitively so each one also gets a lowercased copy
+LOWERCASE_FIELDS = ("product", "category", "store_name", "approved_flag")
+
+def _with_lowercase(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    for field in LOWERCASE_FIELDS:
+        if isinstance(metadata.get(field), str):
+            metadata[f"{field}_lc"] = metadata[field].lower()
+    return metadata
+
+#One document per return order, with the fields we filter on stored as typed metadata
+def _row_to_document(order: ReturnOrder, source: str) -> Document:
+    metadata: Dict[str, Any] = {
+        "source": source,
+        "order_id": order.order_id,
+        "product": order.product,
+        "category": order.category,
+        "store_name": order.store_name,
+        "approved_flag": order.approved_flag,
+        "cost": order.cost,
+        "date": order.date,
+    }
+    try:
+        metadata["date_num"] = _date_num(order.date)
+    except ValueError: #Such a row can still be found by similarity, just not by a date filter
+        pass
+    return Document(page_content=_row_text(order), metadata=_with_lowercase(metadata))
+
+#Every document is stored under the hash of its content, so unchanged rows are never embedded twice
+def _content_id(doc: Document) -> str:
+    payload = doc.page_content + json.dumps(doc.metadata, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def sync_vectorstore():
+    #First loading our CSV file, every row becomes one document
+    dataFrame = pandas.read_csv(SEED_CSV, dtype={"order_id": str, "date": str})
+    documents = []
+    for number, row in enumerate(dataFrame.to_dict("records"), start=1):
+        #A broken seed row must not keep the service from starting, it is only left out of the vector store
+        try:
+            documents.append(_row_to_document(stored_order(row), SEED_CSV))
+        except ValidationError as e:
+            print(f"Skipping seed row {number} (order_id {row.get('order_id')}) in the vector store: {e.errors()[0]['msg']}")
+    doc_ids = {_content_id(doc): doc for doc in documents}
+
+    #Checking which of the hashes are already in the collection, only the rest needs to be embedded
+    existing = set()
+    ids = list(doc_ids)
+    for i in range(0, len(ids), 1000):
+        existing.update(vectorstore.get(ids=ids[i:i + 1000], include=[])["ids"])
+    new_ids = [doc_id for doc_id in ids if doc_id not in existing]
+    if new_ids:
+        await vectorstore.aadd_documents([doc_ids[doc_id] for doc_id in new_ids], ids=new_ids)
+
+    #Removing the documents of seed rows that were changed or deleted in the CSV (inserted returns have another source)
+    stale_ids = [doc_id for doc_id in vectorstore.get(where={"source": SEED_CSV}, include=[])["ids"] if doc_id not in doc_ids]
+    if stale_ids:
+        vectorstore.delete(ids=stale_ids)
+    #Inserted returns embedded before the lowercased metadata existed get it now, their embeddings come from the cache
+    inserted = vectorstore.get(where={"source": {"$ne": SEED_CSV}}, include=["metadatas"])
+    outdated = [doc_id for doc_id, metadata in zip(inserted["ids"], inserted["metadatas"]) if "category_lc" not in (metadata or {})]
+    for i in range(0, len(outdated), 1000):
+        old = vectorstore.get(ids=outdated[i:i + 1000], include=["documents", "metadatas"])
+        docs = [Document(page_content=text, metadata=_with_lowercase(dict(metadata))) for text, metadata in zip(old["documents"], old["metadatas"])]
+        await vectorstore.aadd_documents(docs, ids=[_content_id(doc) for doc in docs])
+        vectorstore.delete(ids=old["ids"])
+    if new_ids or stale_ids or outdated:
+        query_cache.bump()
+    print(f"Vector store synced: {len(new_ids)} embedded, {len(stale_ids)} removed, {len(outdated)} updated, {len(existing)} unchanged")
+
+#Building the Chroma "where" clause from the structured filters of retrieve_data
+def _metadata_filter(category: Optional[str] = None, store_name: Optional[str] = None, product: Optional[str] = None,
+                     approved_flag: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    conditions = []
+    #Matched against the lowercased copies, case does not matter like in the SQL filters
+    for field, value in (("category", category), ("store_name", store_name), ("product", product), ("approved_flag", approved_flag)):
+        if value:
+            conditions.append({f"{field}_lc": {"$eq": value.lower()}})
+    if date_from:
+        conditions.append({"date_num": {"$gte": _date_num(date_from)}})
+    if date_to:
+        conditions.append({"date_num": {"$lte": _date_num(date_to)}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+RETRIEVE_MODES = ("hybrid", "vector", "keyword")
+#Constant of reciprocal rank fusion, ranks below it weigh about the same in both lists
+RRF_K = 60
+#How each retrieve_data call was answered, reported on /stats
+retrieval_counts = {"order_id": 0, "keyword": 0, "fused": 0, "vector": 0}
+
+def _record_text(row: tuple) -> str:
+    return "\n".join(f"{column}: {value}" for column, value in zip(RETURN_COLUMNS, row))
+
+async def _search(query: str, k_n: int, where: Optional[Dict[str, Any]], filters: Dict[str, Any], mode: str) -> List[str]:
+    keyword_rows: List[tuple] = []
+    if mode != "vector":
+        #Order ids asked for by number are answered straight from the table, without the embedding call
+        order_ids = order_ids_in(query)
+        if order_ids:
+            rows = await fetch_orders(order_ids, filters)
+            if rows:
+                retrieval_counts["order_id"] += 1
+                return [_record_text(row) for row in rows[:k_n]]
+        #Rows that contain every keyword of the query are exact matches, similarity would not add better ones
+        terms = search_terms(query)
+        keyword_rows = await keyword_search(terms, filters, k_n, match_all=True)
+        if keyword_rows:
+            retrieval_counts["keyword"] += 1
+            return [_record_text(row) for row in keyword_rows]
+        keyword_rows = await keyword_search(terms, filters, k_n, match_all=False)
+        if mode == "keyword":
+            retrieval_counts["keyword"] += 1
+            return [_record_text(row) for row in keyword_rows]
+
+    search_kwargs: Dict[str, Any] = {"k": k_n}
+    if where:
+        search_kwargs["filter"] = where
+    retriever = vectorstore.as_retriever(search_kwargs=search_kwargs) 
+    chunks = await retriever.ainvoke(query)
+    if not keyword_rows:
+        retrieval_counts["vector"] += 1
+        return [doc.page_content for doc in chunks]
+
+    #Merging the partial keyword matches with the similarity hits by reciprocal rank fusion, one entry per order id
+    scores: Dict[str, float] = {}
+    texts: Dict[str, str] = {}
+    for rank, row in enumerate(keyword_rows):
+        scores[row[0]] = scores.get(row[0], 0.0) + 1 / (RRF_K + rank + 1)
+        texts.setdefault(row[0], _record_text(row))
+    for rank, doc in enumerate(chunks):
+        order_id = str(doc.metadata.get("order_id", doc.page_content))
+        scores[order_id] = scores.get(order_id, 0.0) + 1 / (RRF_K + rank + 1)
+        texts.setdefault(order_id, doc.page_content)
+    retrieval_counts["fused"] += 1
+    return [texts[order_id] for order_id in sorted(scores, key=scores.get, reverse=True)[:k_n]]
 
 #Creating the agent tool to retrieve from the vectore store
 @tool
-async def retrieve_data(query: str, k_n: int = 10) -> str:
-    """Returning the relevant data from the vectore store"""
-    retriever = vectorstore.as_retriever(search_kwargs={"k": k_n}) 
-    chunks = await retriever.ainvoke(query)
-    return "\n\n".join([doc.page_content for doc in chunks])
+async def retrieve_data(query: str, k_n: int = 10, category: Optional[str] = None, store_name: Optional[str] = None,
+                        product: Optional[str] = None, approved_flag: Optional[str] = None,
+                        date_from: Optional[str] = None, date_to: Optional[str] = None, mode: str = "hybrid") -> str:
+    """Returning the relevant data from the vectore store.
+    Optional filters are applied inside the vector store before ranking: category, store_name, product,
+    approved_flag ("Yes"/"No"), matched whole but ignoring case, and an inclusive date window with date_from/date_to in YYYY-MM-DD format.
+    mode='hybrid' (default) answers order ids (e.g. "order 1101") and queries whose keywords all match a row
+    from the keyword index, and merges keyword and similarity hits otherwise; 'vector' and 'keyword' use one of them only."""
+    if mode not in RETRIEVE_MODES:
+        return f"Error: mode must be one of: {', '.join(RETRIEVE_MODES)}."
+    try:
+        where = _metadata_filter(category, store_name, product, approved_flag, date_from, date_to)
+    except ValueError:
+        return "Error: date_from and date_to must be in YYYY-MM-DD format."
+
+    #The same question over the same data gets the same answer, without embedding the query again
+    cache_key = query_cache.key(mode, normalize_query(query), k_n, json.dumps(where, sort_keys=True))
+    cached = query_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    filters = {"category": category, "store_name": store_name, "product": product, "approved_flag": approved_flag,
+               "date_from": date_from, "date_to": date_to}
+    texts = await _search(query, k_n, where, filters, mode)
+    result = "\n\n".join(texts) if texts else "No return orders found."
+    query_cache.put(cache_key, result)
+    return result
 
 #Creating the agent tool to retrieve all the data from the db
 @tool
-async def return_all_data() -> str:
-    """Returning all the data from the database"""
-    async with aiosqlite.connect("customer-data.db") as conn:
+async def return_all_data(format: str = "text") -> str:
+    """Returning all the data from the database.
+    format='batch' returns a compact typed record batch (a string starting with RWBATCH2:) that
+    rep_ag.generate_excel_report reads directly, pass it on unchanged."""
+    async with aiosqlite.connect(RETURNS_DB) as conn:
         cursor = await conn.cursor()
         cursor = await conn.execute("SELECT * FROM return_orders")    
         rows = await cursor.fetchall()
         if not rows:
             return "No return orders found."
+        if format == "batch":
+            return encode_batch(RETURN_COLUMNS, rows)
 
         blocks = []
         for row in rows:
@@ -112,77 +263,245 @@ async def return_all_data() -> str:
             ]))
         return "\n\n".join(blocks)
 
+#Creating the agent tool to page through the db, so a call never loads more rows than it asked for
+@tool
+async def list_return_orders(columns: Optional[List[str]] = None, category: Optional[str] = None, store_name: Optional[str] = None,
+                             product: Optional[str] = None, approved_flag: Optional[str] = None, return_reason: Optional[str] = None,
+                             order_id: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                             order_by: str = "order_id", limit: int = 100, cursor: Optional[str] = None, format: str = "text") -> str:
+    """Lists return orders from the database page by page, prefer it over return_all_data.
+    columns: subset of order_id, product, category, return_reason, cost, approved_flag, store_name, date (default: all).
+    Filters match whole values ignoring case, date_from/date_to is an inclusive YYYY-MM-DD window.
+    order_by is 'order_id' or 'date', limit is at most 1000 rows per page.
+    To get the next page call it again with the same arguments and the returned cursor.
+    format='batch' returns the page as a typed record batch (RWBATCH2:...) for rep_ag.generate_excel_report."""
+    filters = {"category": category, "store_name": store_name, "product": product, "approved_flag": approved_flag,
+               "return_reason": return_reason, "order_id": order_id, "date_from": date_from, "date_to": date_to}
+    try:
+        names, rows, next_cursor, total = await fetch_page(columns, filters, order_by, limit, cursor)
+    except ValueError as e:
+        return f"Error: {str(e)}"
+    if not rows:
+        return f"No return orders found ({total} match the filters)."
+
+    #The dataset id stands for all matching rows, rep_ag can build a report from it without the rows being copied.
+    #It is stored with the first page, the later pages of the same query only compute the same id
+    dataset_id = await save_dataset(filters, columns) if cursor is None else dataset_id_for(filters, columns)
+    footer = f"Showed {len(rows)} of {total} matching return orders. Report dataset_id = {dataset_id}."
+    if next_cursor:
+        footer += f" Next page cursor = {next_cursor}"
+    if format == "batch":
+        return encode_batch(names, rows) + "\n\n" + footer
+
+    blocks = ["\n".join(f"{name}: {value}" for name, value in zip(names, row)) for row in rows]
+    return "\n\n".join(blocks) + "\n\n" + footer
+
+#Rendering a small SQL result as a markdown table for the agent
+def _format_table(columns: List[str], rows: List[tuple]) -> str:
+    lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    for row in rows:
+        lines.append("| " + " | ".join("" if value is None else str(value) for value in row) + " |")
+    return "\n".join(lines)
+
+TIME_BUCKETS = ("day", "week", "month")
+
+#Creating the agent tool for counts, sums and trends, computed by the database instead of the LLM
+@tool
+async def aggregate_returns(group_by: Optional[List[str]] = None, metrics: Optional[List[str]] = None,
+                            category: Optional[str] = None, store_name: Optional[str] = None, product: Optional[str] = None,
+                            approved_flag: Optional[str] = None, return_reason: Optional[str] = None,
+                            date_from: Optional[str] = None, date_to: Optional[str] = None,
+                            compare_previous: bool = False, limit: int = 100) -> str:
+    """Computes counts, sums and averages over the return orders with SQL, use it for any analytics question instead of reading rows.
+    group_by: any of product, category, return_reason, approved_flag, store_name, day, week, month (empty for overall totals).
+    metrics: any of count, total_cost, avg_cost, min_cost, max_cost (default: count and total_cost).
+    Filters match whole values ignoring case, date_from/date_to is an inclusive YYYY-MM-DD window.
+    compare_previous=True (needs date_from and date_to) adds the same metrics for the equally long window right before date_from,
+    so you can tell whether returns are rising or falling. It cannot be combined with the day, week or month groupings.
+    limit is the most groups returned (up to 5000), the answer says when more groups matched."""
+    group_by = group_by or []
+    metrics = metrics or ["count", "total_cost"]
+    filters = {"category": category, "store_name": store_name, "product": product, "approved_flag": approved_flag,
+               "return_reason": return_reason, "date_from": date_from, "date_to": date_to}
+    try:
+        if compare_previous and not (date_from and date_to):
+            return "Error: compare_previous needs both date_from and date_to."
+        #Day, week and month buckets of two different windows never coincide, joining them would compare every bucket with 0
+        time_buckets = [g for g in group_by if g in TIME_BUCKETS]
+        if compare_previous and time_buckets:
+            return (f"Error: compare_previous cannot be combined with group_by {', '.join(time_buckets)}. "
+                    "Compare the totals (optionally grouped by product, category, store, reason or approval), "
+                    "or group by the time bucket over one window that spans both periods.")
+        columns, rows, truncated = await aggregate(group_by, metrics, filters, limit)
+        note = f"\nOnly the first {len(rows)} groups are shown, more groups match. Raise limit or narrow the filters." if truncated else ""
+        if not compare_previous:
+            return (_format_table(columns, rows) + note) if rows else "No return orders match the filters."
+
+        start = datetime.strptime(date_from, "%Y-%m-%d")
+        end = datetime.strptime(date_to, "%Y-%m-%d")
+        previous_to = start - timedelta(days=1)
+        previous_from = previous_to - (end - start)
+        filters.update(date_from=previous_from.strftime("%Y-%m-%d"), date_to=previous_to.strftime("%Y-%m-%d"))
+        _, previous_rows, previous_truncated = await aggregate(group_by, metrics, filters, limit)
+        if previous_truncated and not note:
+            note = f"\nThe previous period has more than {limit} groups, only the first {limit} are compared. Raise limit or narrow the filters."
+
+        #Joining both periods on the group keys, so every row shows the current value, the previous one and the change
+        width = len(group_by)
+        previous = {row[:width]: row[width:] for row in previous_rows}
+        current = {row[:width]: row[width:] for row in rows}
+        merged_columns = group_by + [f"{m}{suffix}" for m in metrics for suffix in ("", "_previous", "_change_pct")]
+        merged_rows = []
+        for key in list(current) + [key for key in previous if key not in current]:
+            values = current.get(key, (0,) * len(metrics))
+            before = previous.get(key, (0,) * len(metrics))
+            cells = list(key)
+            for now_value, old_value in zip(values, before):
+                #A period without matching rows gives NULL sums and averages, which count as 0
+                now_value, old_value = now_value or 0, old_value or 0
+                change = round((now_value - old_value) / old_value * 100, 1) if old_value else None
+                cells += [now_value, old_value, change]
+            merged_rows.append(tuple(cells))
+        header = f"Current period {date_from} to {date_to}, previous period {filters['date_from']} to {filters['date_to']}\n"
+        return header + _format_table(merged_columns, merged_rows) + note
+    except ValueError as e:
+        return f"Error: {str(e)}"
+
 #Creating the agent tool to insert new return order into the db
 @tool
 async def insert_return(order_id: str, product: str, category: str, return_reason: str, cost: float, approved_flag: str, store_name: str, date: str) -> str:
     """Inserting a new return order into the database and returning the current list of return orders"""
-    async with aiosqlite.connect("customer-data.db") as conn:
-        try:
-            cursor = await conn.cursor()
-            await cursor.execute('''
-                INSERT INTO return_orders (order_id, product, category, return_reason, cost, approved_flag, store_name, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (order_id, product, category, return_reason, cost, approved_flag, store_name, date))
-            await conn.commit()
-
-            #Now uploading the new data into the vectore store as well
-            new_chunks = "\n".join([
-                f"order_id: {order_id}",
-                f"product: {product}",
-                f"category: {category}",
-                f"return_reason: {return_reason}",
-                f"cost: {cost}",
-                f"approved_flag: {approved_flag}",
-                f"store_name: {store_name}",
-                f"date: {date}"
-            ])
-            new_doc = Document(page_content=new_chunks)
-            await vectorstore.aadd_documents([new_doc])
-
-            #And for the output we return the current list of return orders
+    try:
+        order = ReturnOrder(order_id=order_id, product=product, category=category, return_reason=return_reason,
+                            cost=cost, approved_flag=approved_flag, store_name=store_name, date=date)
+        #Only the row and its outbox entry are written here, the indexer embeds it into the vector store in the background
+        inserted, = await insert_orders([order], "insert_return")
+        if not inserted:
+            return f"Error inserting data: order_id {order_id} already exists"
+        query_cache.bump()
+        indexer.notify()
+
+        #And for the output we return the current list of return orders
+        async with aiosqlite.connect(RETURNS_DB) as conn:
             cursor = await conn.execute("SELECT order_id, product, store_name, date FROM return_orders")    
             rows = await cursor.fetchall()
-            result = "\n".join([f"Order ID: {row[0]}, Product: {row[1]}, Store: {row[2]}, Date: {row[3]}" for row in rows])
-            return f"Return order inserted successfully. Current return orders:\n{result}"
-        except Exception as e:
-            return f"Error inserting data: {str(e)}"
-
-
-@mcp.tool(description="Retrieves and writes data from the vector store based on the provided query.")
-async def run_rag_ag(query: str = "", session_id: str = "default_session") -> str:
-
-    await setup_db() #First we are setting up the db with our data before running the agent
+        result = "\n".join([f"Order ID: {row[0]}, Product: {row[1]}, Store: {row[2]}, Date: {row[3]}" for row in rows])
+        return f"Return order inserted successfully. Current return orders:\n{result}"
+    except Exception as e:
+        return f"Error inserting data: {str(e)}"
+
+#Documents per embedding request when many returns are added at once
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "500"))
+
+#Embedding inserted return orders into the vector store, called by the outbox indexer with up to OUTBOX_BATCH_SIZE orders
+async def _index_orders(orders: List[ReturnOrder], sources: List[str]) -> None:
+    for start in range(0, len(orders), EMBED_BATCH_SIZE):
+        docs = [_row_to_document(order, source) for order, source in zip(orders[start:start + EMBED_BATCH_SIZE], sources[start:start + EMBED_BATCH_SIZE])]
+        await vectorstore.aadd_documents(docs, ids=[_content_id(doc) for doc in docs])
+
+#Once new documents are searchable, cached similarity results are out of date
+indexer = OutboxIndexer(_index_orders, on_indexed=query_cache.bump)
+
+#Turning one uploaded or passed row into ReturnOrder input, spreadsheet cells come as numbers, dates and NaN
+def _clean_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    cleaned: Dict[str, Any] = {}
+    for key, value in record.items():
+        field = normalize_field(str(key))
+        #Blank cells are missing values, a CSV gives them as "" where an XLSX gives None
+        if value is None or (isinstance(value, float) and value != value) or (isinstance(value, str) and not value.strip()):
+            continue
+        if field == "date" and hasattr(value, "strftime"):
+            value = value.strftime("%Y-%m-%d")
+        elif field != "cost":
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            value = str(value).strip()
+        cleaned[field] = value
+    return cleaned
+
+async def _ingest(records: List[Dict[str, Any]], source: str) -> Dict[str, Any]:
+    """Validates, inserts and embeds many return orders. Returns the counts and the status of every row that was not inserted."""
+    statuses: List[Dict[str, Any]] = []
+    orders: List[ReturnOrder] = []
+    positions: List[int] = []
+    for number, record in enumerate(records, start=1):
+        cleaned = _clean_record(record)
+        try:
+            orders.append(ReturnOrder(**cleaned))
+            positions.append(number)
+        except ValidationError as e:
+            problems = "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+            statuses.append({"row": number, "order_id": str(cleaned.get("order_id", "")), "status": "invalid", "error": problems})
+
+    inserted_flags = await insert_orders(orders, source) if orders else []
+    new_orders = []
+    for number, order, inserted in zip(positions, orders, inserted_flags):
+        if inserted:
+            new_orders.append(order)
+        else:
+            statuses.append({"row": number, "order_id": order.order_id, "status": "duplicate", "error": "order_id already exists"})
+    if new_orders:
+        #The new rows are embedded by the outbox indexer, in large batches
+        query_cache.bump()
+        indexer.notify()
+
+    statuses.sort(key=lambda status: status["row"])
+    return {
+        "total": len(records),
+        "inserted": len(new_orders),
+        "duplicate": sum(1 for status in statuses if status["status"] == "duplicate"),
+        "invalid": sum(1 for status in statuses if status["status"] == "invalid"),
+        "rows": statuses,
+    }
 
-    #Now initializing connection with db, that will be used to store checkpoints to keep conversation memory
+def _ingest_report(result: Dict[str, Any]) -> str:
+    lines = [f"Inserted {result['inserted']} of {result['total']} return orders, "
+             f"{result['duplicate']} duplicate, {result['invalid']} invalid."]
+    for status in result["rows"]:
+        lines.append(f"Row {status['row']} (order_id {status['order_id'] or '-'}): {status['status']}, {status['error']}")
+    return "\n".join(lines)
 
-    async_conn = await aiosqlite.connect("checkpoints_agent.db")
-    checkpointer = AsyncSqliteSaver(async_conn)
+#Creating the agent tool to insert many return orders at once
+@tool
+async def insert_returns_batch(rows: List[Dict[str, Any]]) -> str:
+    """Inserting many new return orders at once. Every row is a dict with order_id, product, category, return_reason,
+    cost, approved_flag, store_name and date (YYYY-MM-DD). Returns the counts and a status line for every row that was not inserted."""
+    try:
+        return _ingest_report(await _ingest(rows, "insert_returns_batch"))
+    except Exception as e:
+        return f"Error inserting data: {str(e)}"
 
-    #Now initializing LLM model that will be used for our agent
-    llm = ChatOpenAI(model="gpt-4.1-mini", temperature=0)
 
-    system_message = """
+#Creating system message for the retrieval agent
+SYSTEM_MESSAGE = """
     You are a retrieval agent for managing customer return orders. 
     Use the 'retrieve_data' tool for queries and 'insert_return' tool for insertions from natural language prompts. 
+    When several return orders are given at once, insert them with one 'insert_returns_batch' call. 
+    For counts, totals, averages or trends (e.g. 'how many iPhones were returned in the past 2 weeks, is it rising') use 'aggregate_returns' instead of reading rows and counting them yourself. 
+    To list stored return orders use 'list_return_orders' with filters, only the columns you need and a limit, and follow its cursor for more pages. 
+    When the data is requested for a report, call 'list_return_orders' with the filters and return its 'Report dataset_id' instead of the rows. 
+    When the query names a category, store, product, approval status or time range, pass them as the filters of 'retrieve_data' instead of raising k_n. 
     After insertion, it's extremely important to output the current list of returned orders you will be rewarded for returning the full list. 
     Prohibited behavior includes vague responses, incomplete lists, or failure to acknowledge the inserted data. 
     Example of prohibited output: 
     '- ... (and many more, up to Order ID: 1100, Product: Tablet, Store: Sunnyvale Town, Date: 2025-01-03)'
 
     """
-    #Configuring the system prompt for our agent
-    system_prompt = ChatPromptTemplate.from_messages([
-    ("system", system_message),
-    MessagesPlaceholder(variable_name="messages"),
-    ])
 
-    #Now creating the agent itself with checkpointer and custom prompt
-    agent_executor = create_react_agent(
-        llm,
-        tools=[retrieve_data, insert_return, return_all_data], #here we are passing the retriever as a tool to our agent
-        prompt=system_prompt,
-        checkpointer=checkpointer
-    )
+#Registry that keeps the checkpointer and the compiled retrieval agent for the lifetime of the service
+registry = AgentRegistry(
+    SYSTEM_MESSAGE,
+    tools=[retrieve_data, insert_return, insert_returns_batch, return_all_data, list_return_orders, aggregate_returns], #here we are passing the retriever as a tool to our agent
+    llm_kwargs={"temperature": 0},
+)
+
+#Random id reported on /ping, so the main agent can notice when this service restarts
+INSTANCE_ID = uuid.uuid4().hex
+
+async def run_rag_ag(query: str = "", session_id: str = "default_session") -> str:
+
+    #Getting the retrieval agent, it is compiled only once
+    agent_executor = await registry.get_agent("gpt-4.1-mini")
 
     #Creating config to keep tracking of all the states in the ag conversation history with checkpointers
     config = RunnableConfig(configurable={"thread_id": session_id}, recursion_limit=70)
@@ -195,29 +514,66 @@ async def run_rag_ag(query: str = "", session_id: str = "default_session") -> st
     print("Agent execution completed")
 
     #And finally retrieve the final state from the checkpointer to extract the agent's output
-    checkpoint = await checkpointer.aget(config)
-    final_output_text = ""
-    if checkpoint:
-        state = checkpoint["channel_values"]
-        messages = state.get("messages", [])
-        for message in reversed(messages):
-            if getattr(message, "type", "") == "ai" and not getattr(message, "tool_calls", []): #Ensuring we get the final agent message, but not a tool call
-                raw_content = getattr(message, "content", "")
-                final_output_text = raw_content
-                break
-    else:
-        print("No checkpoint found for final state")
-
-    return final_output_text if final_output_text else "No output generated"
+    return await registry.final_output(config)
+
+#In flat tool mode the coordinator calls the data tools in one hop, otherwise it asks the retrieval agent
+if MCP_FLAT_TOOLS:
+    add_flat_tools(mcp, registry.local_tools)
+else:
+    mcp.add_tool(run_rag_ag, description="Retrieves and writes data from the vector store based on the provided query.")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if await setup_db(): #First we are setting up the db with our data, it is only reloaded when the seed file changed
+        query_cache.bump()
+    await sync_vectorstore()
+    indexer.start() #Catching up with the rows that were inserted but not embedded before the last shutdown
+    if not MCP_FLAT_TOOLS: #The retrieval agent is only needed when it is exposed
+        await registry.start()
+    yield
+    if not MCP_FLAT_TOOLS:
+        await registry.close()
+    await indexer.close()
+    embeddings.close()
 
 app = FastAPI(
-    title="RAG Agent"
+    title="RAG Agent",
+    lifespan=lifespan
 )
 
+#Reading an uploaded CSV or XLSX file into row dicts (blocking, run it in a thread)
+def _read_upload(filename: str, content: bytes) -> List[Dict[str, Any]]:
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        dataFrame = pandas.read_excel(io.BytesIO(content), dtype=object)
+    elif filename.lower().endswith(".csv"):
+        dataFrame = pandas.read_csv(io.BytesIO(content), dtype=str, keep_default_na=False)
+    else:
+        raise ValueError("Upload a .csv or .xlsx file")
+    return dataFrame.to_dict("records")
+
+@app.post("/upload_returns") #Bulk loading return orders from a CSV or XLSX file
+async def upload_returns(file: UploadFile = File(...)):
+    content = await file.read()
+    try:
+        records = await asyncio.to_thread(_read_upload, file.filename or "", content)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not read the file: {e}")
+    return await _ingest(records, f"upload:{file.filename}")
+
 @app.get("/ping")
 async def ping():
     return {
         "status": "ok",
+        "instance_id": INSTANCE_ID,
+    }
+
+@app.get("/stats")
+async def stats():
+    return {
+        "embedding_cache": embeddings.stats(),
+        "query_cache": query_cache.stats(),
+        "retrieval": retrieval_counts,
+        "outbox": {**await outbox_stats(), "indexed": indexer.indexed, "failures": indexer.failures},
     }
 
 app.mount("/", mcp.sse_app())
\ No newline at end of file
@@ -0,0 +1,59 @@
+import json
+import zlib
+import base64
+import pandas
+from typing import Any, Dict, List, Sequence
+
+#Record batches travel as one string, so they can go through MCP tool results and arguments unchanged.
+#RWBATCH2:<crc32 of the payload>:<base64 payload>, the checksum catches a batch that was altered on the way
+BATCH_PREFIX = "RWBATCH2:"
+#Where the agent should go when a batch cannot be used
+BATCH_FALLBACK = "Use generate_report_from_query with the filters or the Report dataset_id from rag_ag instead of copying rows."
+
+#Column types of return_orders, anything not listed here is kept as text
+COLUMN_TYPES = {
+    "cost": "float",
+}
+
+
+def is_batch(data: str) -> bool:
+    #Any version counts, so an outdated or damaged batch gets a clear error instead of being parsed as text
+    return isinstance(data, str) and data.lstrip().startswith("RWBATCH")
+
+def encode_batch(columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> str:
+    """Packs rows into a typed, columnar, zlib-compressed record batch string."""
+    payload: Dict[str, Any] = {
+        "columns": list(columns),
+        "types": {name: COLUMN_TYPES.get(name, "str") for name in columns},
+        "data": {name: [row[i] for row in rows] for i, name in enumerate(columns)},
+    }
+    raw = json.dumps(payload, separators=(",", ":"), default=str).encode("utf-8")
+    encoded = base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+    return f"{BATCH_PREFIX}{zlib.crc32(encoded.encode('ascii')):08x}:{encoded}"
+
+def verify_batch(data: str) -> str:
+    """Checks the version and checksum of a record batch and returns its payload, raises ValueError with what to do instead."""
+    text = data.strip().split("\n\n", 1)[0].strip()
+    if not text.startswith(BATCH_PREFIX):
+        raise ValueError(f"Unsupported record batch version. {BATCH_FALLBACK}")
+    checksum, _, encoded = text[len(BATCH_PREFIX):].partition(":")
+    if not encoded or f"{zlib.crc32(encoded.encode('ascii', 'replace')):08x}" != checksum.lower():
+        raise ValueError(f"The record batch was changed on its way here (checksum mismatch). {BATCH_FALLBACK}")
+    return encoded
+
+def decode_batch(data: str) -> pandas.DataFrame:
+    """Builds the DataFrame of a record batch straight from its columns, without any text parsing."""
+    encoded = verify_batch(data)
+    try:
+        payload = json.loads(zlib.decompress(base64.b64decode(encoded)))
+    except Exception as e:
+        raise ValueError(f"Invalid record batch: {e}. {BATCH_FALLBACK}")
+
+    columns: List[str] = payload["columns"]
+    dataFrame = pandas.DataFrame(payload["data"], columns=columns)
+    for name, kind in payload.get("types", {}).items():
+        if kind == "float":
+            dataFrame[name] = pandas.to_numeric(dataFrame[name], errors="coerce")
+        else:
+            dataFrame[name] = dataFrame[name].astype(str)
+    return dataFrame
@@ -1,24 +1,23 @@
 import os
-import aiosqlite
-from langgraph.prebuilt import create_react_agent
+import asyncio
+from contextlib import asynccontextmanager
 from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import HumanMessage
 from dotenv import load_dotenv
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-from langchain_openai import ChatOpenAI
-from typing import Any, Dict, List
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from typing import Any, Dict, List, Optional
 from langchain_core.tools import tool
-import pandas
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
 from mcp.server.fastmcp import FastMCP
-from fastapi.staticfiles import StaticFiles
+from agent_registry import MCP_FLAT_TOOLS, AgentRegistry, add_flat_tools
+from returns_store import load_dataset
+from report_jobs import ReportJobs, _to_text
+from report_cache import ReportCache
+from record_batch import is_batch, verify_batch
+from email.utils import parsedate_to_datetime
 import uuid
 from pathlib import Path
-import re
 
 mcp = FastMCP()
 
@@ -28,174 +27,106 @@ PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000")
 REPORTS_DIR = Path(os.getenv("REPORTS_DIR", "./reports")).resolve()
 REPORTS_DIR.mkdir(parents=True, exist_ok=True)
 
-#Here i created a function to coerce the OpenAI message content into the plain text
-def _to_text(content: Any) -> str:
-    """Coerce LC message content (str | list[dict|str] | other) to plain text."""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, dict) and "text" in item and isinstance(item["text"], str):
-                parts.append(item["text"])
-            elif isinstance(item, str):
-                parts.append(item)
-        return "\n".join(parts)
-    return str(content)
-
-#This is a function to normalize the keys from the user input to match our model fields
-def _norm_key(k: str) -> str:
-    k = k.strip()
-    # common mappings to snake_case
-    k = k.lower()
-    k = k.replace(" ", "_")
-    k = k.replace("-", "_")
-    # specific synonyms
-    mapping = {
-        "order_id": "order_id",
-        "product": "product",
-        "category": "category",
-        "return_reason": "return_reason",
-        "reason": "return_reason",
-        "cost": "cost",
-        "price": "cost",
-        "approved": "approved_flag",
-        "approved_flag": "approved_flag",
-        "store": "store_name",
-        "store_name": "store_name",
-        "date": "date",
-    }
-    return mapping.get(k, k)
-
-#One more function for a record parsing from the user input
-def _parse_records(data: str) -> List[Dict[str, str]]:
-    records: List[Dict[str, str]] = []
-
-    #If we see ", " and multiple ":" in a single line it treats treat as format B
-    lines = [ln for ln in data.splitlines() if ln.strip()]
-    looks_like_b = any(ln.count(":") >= 2 and ", " in ln for ln in lines)
-
-    if looks_like_b:
-        for ln in lines:
-            row: Dict[str, str] = {}
-            for part in ln.split(","):
-                if ":" in part:
-                    k, v = part.split(":", 1)
-                    row[_norm_key(k)] = v.strip()
-            if row:
-                records.append(row)
-    else:
-        # format A
-        chunks = re.split(r"\n\s*\n", data.strip())
-        for chunk in chunks:
-            row: Dict[str, str] = {}
-            for ln in chunk.splitlines():
-                if ":" in ln:
-                    k, v = ln.split(":", 1)
-                    row[_norm_key(k)] = v.strip()
-            if row:
-                records.append(row)
-
-    return records
-
+#Reports are built as jobs in a pool of worker processes, the tools only submit them
+report_jobs = ReportJobs(REPORTS_DIR)
+#Index of the report files, old reports and the ones over the size quota are evicted in the background
+report_cache = ReportCache(REPORTS_DIR)
+REPORT_EVICT_INTERVAL = float(os.getenv("REPORT_EVICT_INTERVAL", "600"))
+#Report files never change once written, a new report always gets a new name
+REPORT_CACHE_CONTROL = "private, max-age=86400, immutable"
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def _job_links(job: Dict[str, Any]) -> str:
+    job_id = job["job_id"]
+    if job["status"] == "done":
+        filename = job["filename"]
+        return (
+            f"Excel report {'reused, the same data was already reported' if job['cached'] else 'generated'} (job {job_id}).\n\n"
+            f"- Direct link: {PUBLIC_BASE_URL}/files/{filename}\n"
+            f"- Force download: {PUBLIC_BASE_URL}/download/{filename}\n"
+        )
+    if job["status"] == "failed":
+        return f"Report job {job_id} failed: {job['error']}"
+    return (
+        f"Report job {job_id} is {job['status']}.\n\n"
+        f"- Status: {PUBLIC_BASE_URL}/jobs/{job_id}\n"
+        f"- Download once ready: {PUBLIC_BASE_URL}/jobs/{job_id}/result\n"
+    )
 
 #Creating the agent tool to generate the report
 @tool
 async def generate_excel_report(data: str) -> str:
-    """Generates an Excel report with Summary and Findings from the provided return orders data string."""
+    """Generates an Excel report with Summary and Findings from the provided return orders data.
+    Accepts a record batch string (RWBATCH2:...) from rag_ag as-is, or the plain 'key: value' text.
+    For rows that are in the database prefer generate_report_from_query."""
     try:
-        # Parse the data string assuming format from retrieve_data: newline-separated key-value pairs, chunks are separated by \n\n)
         raw = data if isinstance(data, str) else _to_text(data)
-        rows = _parse_records(raw)
-
-        if not rows:
+        if not raw.strip():
             return "Error: No valid data provided to generate report."
-
-        dataFrame = pandas.DataFrame(rows)
-        # Ensure numeric columns
-        if 'cost' in dataFrame.columns:
-            dataFrame['cost'] = pandas.to_numeric(dataFrame['cost'], errors='coerce')
-        for col in ("approved_flag", "product", "category", "return_reason", "store_name"):
-            if col in dataFrame.columns:
-                dataFrame[col] = dataFrame[col].astype(str)
-            
-        #Formating the summary of all the data in the dataframe
-        summary = {
-            'Total Returns': len(dataFrame),
-            'Total Cost': dataFrame['cost'].sum() if 'cost' in dataFrame.columns else 0.0,
-            'Average Cost': dataFrame['cost'].mean() if 'cost' in dataFrame.columns else 0.0,
-            'By Category': dataFrame['category'].value_counts().to_dict() if 'category' in dataFrame.columns else {},
-            'By Return Reason': dataFrame['return_reason'].value_counts().to_dict() if 'return_reason' in dataFrame.columns else {},
-            'By Store': dataFrame['store_name'].value_counts().to_dict() if 'store_name' in dataFrame.columns else {},
-            'Approved Count': dataFrame['approved_flag'].value_counts().get('Yes', 0) if 'approved_flag' in dataFrame.columns else 0,
-        }
-
-        #Now I use LLM to generate findings based on the summary provided
-        llm = ChatOpenAI(model="gpt-5-mini", reasoning={"effort": "minimal"})
-        findings_prompt = (
-            "Analyze the following summary of customer return orders and generate 5-10 key findings or insights. "
-            "Focus on trends, common issues, potential business impacts, and recommendations. "
-            f"Summary: {summary}"
-        )
-        findings_response = await llm.ainvoke(findings_prompt)
-        findings_text = _to_text(findings_response.content)
-        findings_lines = [ln.strip() for ln in findings_text.splitlines() if ln.strip()]
-        # findings = findings_response.content
-
-
-        #Creating the excel file containing three sheets Raw Data, Summary and Findings
-        REPORTS_DIR.mkdir(parents=True, exist_ok=True)
-        stem = f"return_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
-        filename = f"{stem}.xlsx"
-        file_path = REPORTS_DIR / filename
-        with pandas.ExcelWriter(file_path, engine='openpyxl') as writer:
-            dataFrame.to_excel(writer, sheet_name='Raw Data', index=False)
-            pandas.DataFrame.from_dict(summary, orient='index', columns=['Value']).to_excel(writer, sheet_name='Summary')
-            pandas.DataFrame({"Findings": findings_lines}).to_excel(writer, sheet_name='Findings', index=False)
-        
-        url_files = f"{PUBLIC_BASE_URL}/files/{filename}"
-        url_download = f"{PUBLIC_BASE_URL}/download/{filename}"
-
-        return (
-            f"Excel report generated.\n\n"
-            f"- Direct link: {url_files}\n"
-            f"- Force download: {url_download}\n"
-        )
-
-        return f"Excel report generated successfully at {file_path}"
+        #A damaged batch is rejected now, not when the job fails in the background
+        if is_batch(raw):
+            verify_batch(raw)
+        #The data is parsed in the worker process together with the rest of the report
+        job_id = report_jobs.submit({"data": raw})
+        return _job_links(report_jobs.get(job_id))
     except Exception as e:
         return f"Error generating report: {str(e)}"
 
-@mcp.tool(description="Generates an Excel report with Summary and Findings from the provided return orders data string.")
-async def run_rep_ag(query: str, session_id: str = "default_session") -> str:
+#Creating the agent tool that reads the report rows straight from the returns database, so they never pass through the LLM
+@tool
+async def generate_report_from_query(dataset_id: Optional[str] = None, category: Optional[str] = None, store_name: Optional[str] = None,
+                                     product: Optional[str] = None, approved_flag: Optional[str] = None, return_reason: Optional[str] = None,
+                                     date_from: Optional[str] = None, date_to: Optional[str] = None, columns: Optional[List[str]] = None) -> str:
+    """Generates an Excel report with Summary and Findings by reading the return orders directly from the database.
+    Pass a dataset_id returned by rag_ag, or describe the rows with filters (whole values, case ignored) and an inclusive
+    date_from/date_to window in YYYY-MM-DD format (no filters means all return orders).
+    columns optionally limits the Raw Data sheet to a subset of order_id, product, category, return_reason, cost, approved_flag, store_name, date."""
+    try:
+        if dataset_id:
+            spec = await load_dataset(dataset_id)
+            filters, columns = spec["filters"], spec["columns"]
+        else:
+            filters = {"category": category, "store_name": store_name, "product": product, "approved_flag": approved_flag,
+                       "return_reason": return_reason, "date_from": date_from, "date_to": date_to}
+        #The worker process reads the rows itself, so they are never copied between processes
+        job_id = report_jobs.submit({"filters": filters, "columns": columns})
+        return _job_links(report_jobs.get(job_id))
+    except Exception as e:
+        return f"Error generating report: {str(e)}"
 
-    #Now initializing connection with db, that will be used to store checkpoints to keep conversation memory
+#Creating the agent tool that tells how a submitted report job is doing
+@tool
+async def get_report_job(job_id: str) -> str:
+    """Returns the status of a report job (queued, running, done or failed) and its links once the report is ready."""
+    job = report_jobs.get(job_id)
+    if job is None:
+        return f"Unknown report job '{job_id}'."
+    return _job_links(job)
+
+#Creating system message for the report agent
+SYSTEM_MESSAGE = """
+    You are a report generation agent for customer return orders. 
+    When the query describes which returns to report on (filters, a date window or a dataset_id) or asks for all returns, 
+    use the 'generate_report_from_query' tool, it reads the rows from the database itself. 
+    Only when the query contains the data itself, use the 'generate_excel_report' tool and pass the data directly to it. 
+    Reports are built in the background: return the job id and the links given by the tool as they are, do not wait for the report. 
+    When asked about an earlier report job, use the 'get_report_job' tool.
+    """
 
-    async_conn = await aiosqlite.connect("checkpoints_agent.db")
-    checkpointer = AsyncSqliteSaver(async_conn)
+#Registry that keeps the checkpointer and the compiled report agent for the lifetime of the service
+registry = AgentRegistry(
+    SYSTEM_MESSAGE,
+    tools=[generate_report_from_query, generate_excel_report, get_report_job],
+    llm_kwargs={"temperature": 0.1},
+)
 
-    #Now initializing LLM model that will be used for our agent
-    llm = ChatOpenAI(model="gpt-4.1-mini", temperature=0.1)
+#Random id reported on /ping, so the main agent can notice when this service restarts
+INSTANCE_ID = uuid.uuid4().hex
 
-    system_message = """
-    You are a report generation agent for customer return orders. 
-    Analyze the provided data in the user query and use the 'generate_excel_report' tool to create an Excel report with Summary and Findings. 
-    Extract the data from the query and pass it directly to the tool.
-    """
+async def run_rep_ag(query: str, session_id: str = "default_session") -> str:
 
-    #Configuring the system prompt for our agent
-    system_prompt = ChatPromptTemplate.from_messages([
-    ("system", system_message),
-    MessagesPlaceholder(variable_name="messages"),
-    ])
-
-    #Now creating the agent itself with checkpointer and custom prompt
-    agent_executor = create_react_agent(
-        llm,
-        tools=[generate_excel_report],
-        prompt=system_prompt,
-        checkpointer=checkpointer
-    )
+    #Getting the report agent, it is compiled only once
+    agent_executor = await registry.get_agent("gpt-4.1-mini")
 
     #Creating config to keep tracking of all the states in the ag conversation history with checkpointers
     config = RunnableConfig(configurable={"thread_id": session_id}, recursion_limit=70)
@@ -208,47 +139,124 @@ async def run_rep_ag(query: str, session_id: str = "default_session") -> str:
     print("Agent execution completed")
 
     #And finally retrieve the final state from the checkpointer to extract the agent's output
-    checkpoint = await checkpointer.aget(config)
-    final_output_text = ""
-    if checkpoint:
-        state = checkpoint["channel_values"]
-        messages = state.get("messages", [])
-        for message in reversed(messages):
-            if getattr(message, "type", "") == "ai" and not getattr(message, "tool_calls", []): #Ensuring we get the final agent message, but not a tool call
-                raw_content = getattr(message, "content", "")
-                final_output_text = raw_content
-                break
-    else:
-        print("No checkpoint found for final state")
-
-    return final_output_text if final_output_text else "No output generated"
+    return await registry.final_output(config)
+
+#In flat tool mode the coordinator calls the report tools in one hop, otherwise it asks the report agent
+if MCP_FLAT_TOOLS:
+    add_flat_tools(mcp, registry.local_tools)
+else:
+    mcp.add_tool(run_rep_ag, description="Generates an Excel report with Summary and Findings from the provided return orders data string.")
+
+async def _evict_reports() -> None:
+    while True:
+        try:
+            removed = await asyncio.to_thread(report_cache.evict)
+            if removed:
+                print(f"Evicted {removed} report files")
+        except Exception as e:
+            print(f"Report eviction failed: {e}")
+        await asyncio.sleep(REPORT_EVICT_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    report_jobs.start()
+    if not MCP_FLAT_TOOLS: #The report agent is only needed when it is exposed
+        await registry.start()
+    evictor = asyncio.create_task(_evict_reports())
+    yield
+    evictor.cancel()
+    await asyncio.gather(evictor, return_exceptions=True)
+    if not MCP_FLAT_TOOLS:
+        await registry.close()
+    await report_jobs.close()
+    report_cache.close()
 
 app = FastAPI(
-    title="Report Agent"
+    title="Report Agent",
+    lifespan=lifespan
 )
 
-@app.get("/download/{filename}") #Endpoint to download the generated by the agnet report
-async def download_file(filename: str):
+def _not_modified(request: Request, response: FileResponse) -> bool:
+    #If-None-Match wins over If-Modified-Since when a client sends both
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or response.headers["etag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(response.headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+async def _report_response(request: Request, filename: str, disposition: str) -> Response:
+    """Serves a report file with ETag/Last-Modified validators, 304 answers, Range support and cache headers."""
+    #Only report workbooks are served, never the index or anything outside the reports directory
+    if filename != Path(filename).name or not filename.endswith(".xlsx"):
+        raise HTTPException(status_code=404, detail="File not found")
     fullpath = REPORTS_DIR / filename
-    if not fullpath.exists():
+    try:
+        stat_result = os.stat(fullpath)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(
+
+    #FileResponse computes the ETag and Last-Modified headers and answers Range requests with 206
+    response = FileResponse(
         path=str(fullpath),
         filename=filename,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        media_type=XLSX_MEDIA_TYPE,
+        stat_result=stat_result,
+        content_disposition_type=disposition,
+        headers={"Cache-Control": REPORT_CACHE_CONTROL},
     )
+    if _not_modified(request, response):
+        return Response(status_code=304, headers={
+            "ETag": response.headers["etag"],
+            "Last-Modified": response.headers["last-modified"],
+            "Cache-Control": REPORT_CACHE_CONTROL,
+        })
+    #The index update is a blocking SQLite commit, it runs in a thread like the eviction
+    await asyncio.to_thread(report_cache.touch, filename)
+    return response
 
+@app.get("/download/{filename}") #Endpoint to download the generated by the agnet report
+async def download_file(filename: str, request: Request):
+    return await _report_response(request, filename, "attachment")
+
+@app.get("/files/{filename}") #Same file opened in place by the browser instead of saved
+async def open_file(filename: str, request: Request):
+    return await _report_response(request, filename, "inline")
+
+@app.get("/jobs/{job_id}") #Status of a report job
+async def job_status(job_id: str):
+    job = report_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["filename"]:
+        job["download_url"] = f"{PUBLIC_BASE_URL}/download/{job['filename']}"
+    return job
+
+@app.get("/jobs/{job_id}/result") #Redirects to the report once the job is done, 202 while it is still running
+async def job_result(job_id: str):
+    job = report_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=job["error"])
+    if job["status"] != "done":
+        return JSONResponse(job, status_code=202, headers={"Retry-After": "2"})
+    return RedirectResponse(f"/download/{job['filename']}", status_code=303)
 
 @app.get("/ping")
 async def ping():
     return {
         "status": "ok",
+        "instance_id": INSTANCE_ID,
     }
 
 app.mount("/", mcp.sse_app()) #mounting mcp app 
 
-app.mount("/files", StaticFiles(directory=str(REPORTS_DIR), html=False), name="files")
-
 
 app.add_middleware( #adding allowence for url clicking in browser
     CORSMiddleware,
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import pandas
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Age and total size limits of the cached report workbooks
+REPORT_CACHE_TTL_SECONDS = float(os.getenv("REPORT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+#Bumped whenever the workbook layout changes, so older cached files are not served for new requests
+REPORT_FORMAT_VERSION = 1
+
+
+def dataset_key(dataFrame: pandas.DataFrame, options: Optional[Dict[str, Any]] = None) -> str:
+    """Content hash of a report's data and options, independent of the column order and the row index."""
+    normalized = dataFrame[sorted(dataFrame.columns)]
+    if "order_id" in normalized.columns:
+        normalized = normalized.sort_values("order_id", kind="stable")
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "version": REPORT_FORMAT_VERSION,
+        "columns": list(normalized.columns),
+        "options": options or {},
+    }, sort_keys=True).encode("utf-8"))
+    digest.update(pandas.util.hash_pandas_object(normalized, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def source_key(source: Dict[str, Any]) -> str:
+    """Hash of the query spec or inline data a report was requested with."""
+    filters = {k: v for k, v in (source.get("filters") or {}).items() if v not in (None, "")}
+    raw = json.dumps({**source, "filters": filters} if "filters" in source else source, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def summary_key(summary: Dict[str, Any], model: str) -> str:
+    raw = json.dumps({"model": model, "summary": summary}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """Index of the generated workbooks by dataset hash, plus the findings text by summary hash."""
+
+    def __init__(self, reports_dir: Path, ttl_seconds: float = REPORT_CACHE_TTL_SECONDS, max_bytes: int = REPORT_CACHE_MAX_BYTES):
+        self.reports_dir = reports_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.reports_dir.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(reports_dir / "report_index.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS reports (
+            cache_key TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            source_hash TEXT
+            )
+            ''')
+        #Indexes created before the source hash was recorded get the column added
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(reports)")]
+        if "source_hash" not in columns:
+            self._conn.execute("ALTER TABLE reports ADD COLUMN source_hash TEXT")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS findings (
+            summary_key TEXT PRIMARY KEY,
+            findings TEXT NOT NULL,
+            created_at REAL NOT NULL
+            )
+            ''')
+        self._conn.commit()
+
+    def lookup(self, cache_key: str) -> Optional[str]:
+        """Returns the filename of a fresh report for the key, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT filename, created_at FROM reports WHERE cache_key = ?", (cache_key,)).fetchone()
+            if not row:
+                return None
+            filename, created_at = row
+            if now - created_at > self.ttl_seconds or not (self.reports_dir / filename).exists():
+                self._conn.execute("DELETE FROM reports WHERE cache_key = ?", (cache_key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE reports SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+            self._conn.commit()
+            return filename
+
+    def store(self, cache_key: str, filename: str, source_hash: Optional[str] = None) -> None:
+        now = time.time()
+        size = (self.reports_dir / filename).stat().st_size
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reports (cache_key, filename, size, created_at, last_access, source_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, filename, size, now, now, source_hash),
+            )
+            self._conn.commit()
+
+    def touch(self, filename: str) -> None:
+        """Marks a report as used, so a downloaded report is evicted after the ones nobody looked at."""
+        with self._lock:
+            self._conn.execute("UPDATE reports SET last_access = ? WHERE filename = ?", (time.time(), filename))
+            self._conn.commit()
+
+    def _index_untracked(self) -> None:
+        #Reports written before the index existed (or by an older version) are indexed with their file time
+        with self._lock:
+            known = {row[0] for row in self._conn.execute("SELECT filename FROM reports")}
+            for path in self.reports_dir.glob("return_report_*.xlsx"):
+                if path.name in known:
+                    continue
+                stat = path.stat()
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO reports (cache_key, filename, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    ("file:" + path.name, path.name, stat.st_size, stat.st_mtime, stat.st_mtime),
+                )
+            self._conn.commit()
+
+    def get_findings(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            row = self._conn.execute("SELECT findings, created_at FROM findings WHERE summary_key = ?", (key,)).fetchone()
+        if not row or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def store_findings(self, key: str, findings_lines: List[str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO findings (summary_key, findings, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(findings_lines), time.time()),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """Drops reports older than the TTL, then the least recently used ones until the total size fits the quota."""
+        self._index_untracked()
+        now = time.time()
+        removed = []
+        with self._lock:
+            removed += self._conn.execute(
+                "SELECT cache_key, filename FROM reports WHERE created_at < ?", (now - self.ttl_seconds,)
+            ).fetchall()
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM reports WHERE created_at >= ?", (now - self.ttl_seconds,)).fetchone()[0]
+            if total > self.max_bytes:
+                for cache_key, filename, size in self._conn.execute(
+                    "SELECT cache_key, filename, size FROM reports WHERE created_at >= ? ORDER BY last_access",
+                    (now - self.ttl_seconds,),
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    removed.append((cache_key, filename))
+                    total -= size
+            self._conn.executemany("DELETE FROM reports WHERE cache_key = ?", [(cache_key,) for cache_key, _ in removed])
+            self._conn.execute("DELETE FROM findings WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.commit()
+        for _, filename in removed:
+            (self.reports_dir / filename).unlink(missing_ok=True)
+        return len(removed)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,102 @@
+import math
+import pandas
+import xlsxwriter
+from pathlib import Path
+from typing import Any, Dict, List
+
+#Excel has 1,048,576 rows per sheet, one of them is the header
+EXCEL_MAX_ROWS = 1_048_576
+WRITE_CHUNK_ROWS = 50_000
+
+#Summary entries that count the returns per value of a column
+SUMMARY_DIMENSIONS = {
+    "By Category": "category",
+    "By Return Reason": "return_reason",
+    "By Store": "store_name",
+}
+
+
+def _plain(value: Any) -> Any:
+    #numpy scalars would show up as np.int64(...) in the findings prompt
+    return value.item() if hasattr(value, "item") else value
+
+def summarize(dataFrame: pandas.DataFrame) -> Dict[str, Any]:
+    """Computes every summary grouping from one groupby pass over the data.
+
+    The rows are grouped once by all summary columns together, every per-column count is then
+    rolled up from that small aggregate instead of scanning the full data again.
+    """
+    has_cost = "cost" in dataFrame.columns
+    dimensions = [c for c in ("category", "return_reason", "store_name", "approved_flag") if c in dataFrame.columns]
+
+    if dimensions:
+        aggregations = {"count": (dimensions[0], "size")}
+        if has_cost:
+            aggregations.update(cost_sum=("cost", "sum"), cost_count=("cost", "count"))
+        cube = dataFrame.groupby(dimensions, dropna=False, sort=False).agg(**aggregations)
+        total_cost = cube["cost_sum"].sum() if has_cost else 0.0
+        cost_count = cube["cost_count"].sum() if has_cost else 0
+    else:
+        cube = None
+        total_cost = dataFrame["cost"].sum() if has_cost else 0.0
+        cost_count = dataFrame["cost"].count() if has_cost else 0
+
+    def counts(column: str) -> Dict[str, int]:
+        if cube is None or column not in dimensions:
+            return {}
+        rolled = cube.groupby(level=column, dropna=False, sort=False)["count"].sum().sort_values(ascending=False, kind="stable")
+        return {str(key): int(value) for key, value in rolled.items()}
+
+    summary: Dict[str, Any] = {
+        'Total Returns': len(dataFrame),
+        'Total Cost': _plain(total_cost),
+        'Average Cost': _plain(total_cost / cost_count) if cost_count else (float("nan") if has_cost else 0.0),
+    }
+    for label, column in SUMMARY_DIMENSIONS.items():
+        summary[label] = counts(column)
+    summary['Approved Count'] = counts("approved_flag").get("Yes", 0)
+    return summary
+
+def write_workbook(file_path: Path, dataFrame: pandas.DataFrame, summary: Dict[str, Any], findings_lines: List[str]) -> None:
+    """Writes the Raw Data, Summary and Findings sheets in xlsxwriter's constant-memory mode.
+
+    Rows are flushed to disk as they are written, so memory does not grow with the report size.
+    Data that does not fit one sheet continues on 'Raw Data 2', 'Raw Data 3' and so on.
+    """
+    workbook = xlsxwriter.Workbook(str(file_path), {
+        "constant_memory": True,
+        #Cells are written as the values they are, never turned into formulas or links
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+    })
+    try:
+        columns = [str(c) for c in dataFrame.columns]
+        rows_per_sheet = EXCEL_MAX_ROWS - 1
+        sheet_count = max(1, math.ceil(len(dataFrame) / rows_per_sheet))
+        for sheet_index in range(sheet_count):
+            worksheet = workbook.add_worksheet("Raw Data" if sheet_count == 1 else f"Raw Data {sheet_index + 1}")
+            worksheet.write_row(0, 0, columns)
+            start = sheet_index * rows_per_sheet
+            end = min(start + rows_per_sheet, len(dataFrame))
+            row_number = 1
+            for chunk_start in range(start, end, WRITE_CHUNK_ROWS):
+                chunk = dataFrame.iloc[chunk_start:min(chunk_start + WRITE_CHUNK_ROWS, end)]
+                #Missing values become empty cells, like pandas.to_excel writes them
+                chunk = chunk.astype(object).where(chunk.notna(), None)
+                for row in chunk.itertuples(index=False, name=None):
+                    worksheet.write_row(row_number, 0, row)
+                    row_number += 1
+
+        worksheet = workbook.add_worksheet("Summary")
+        worksheet.write_row(0, 0, ["", "Value"])
+        for row_number, (key, value) in enumerate(summary.items(), start=1):
+            if isinstance(value, float) and not math.isfinite(value):
+                value = None
+            worksheet.write_row(row_number, 0, [key, str(value) if isinstance(value, dict) else value])
+
+        worksheet = workbook.add_worksheet("Findings")
+        worksheet.write(0, 0, "Findings")
+        for row_number, line in enumerate(findings_lines, start=1):
+            worksheet.write_string(row_number, 0, line)
+    finally:
+        workbook.close()
@@ -0,0 +1,240 @@
+import os
+import re
+import time
+import uuid
+import asyncio
+import multiprocessing
+import pandas
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+from langchain_openai import ChatOpenAI
+from record_batch import decode_batch, is_batch
+from returns_store import normalize_field, read_dataframe
+from report_engine import summarize, write_workbook
+from report_cache import ReportCache, dataset_key, source_key, summary_key
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Number of worker processes building reports, more jobs than that wait in the queue
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+#Finished jobs are forgotten after this many seconds, their files stay until the report cache evicts them
+REPORT_JOB_TTL_SECONDS = float(os.getenv("REPORT_JOB_TTL_SECONDS", "3600"))
+FINDINGS_MODEL = "gpt-5-mini"
+
+
+#Here i created a function to coerce the OpenAI message content into the plain text
+def _to_text(content: Any) -> str:
+    """Coerce LC message content (str | list[dict|str] | other) to plain text."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if isinstance(item, dict) and "text" in item and isinstance(item["text"], str):
+                parts.append(item["text"])
+            elif isinstance(item, str):
+                parts.append(item)
+        return "\n".join(parts)
+    return str(content)
+
+#One more function for a record parsing from the user input
+def _parse_records(data: str) -> List[Dict[str, str]]:
+    records: List[Dict[str, str]] = []
+
+    #If we see ", " and multiple ":" in a single line it treats treat as format B
+    lines = [ln for ln in data.splitlines() if ln.strip()]
+    looks_like_b = any(ln.count(":") >= 2 and ", " in ln for ln in lines)
+
+    if looks_like_b:
+        for ln in lines:
+            row: Dict[str, str] = {}
+            for part in ln.split(","):
+                if ":" in part:
+                    k, v = part.split(":", 1)
+                    row[normalize_field(k)] = v.strip()
+            if row:
+                records.append(row)
+    else:
+        # format A
+        chunks = re.split(r"\n\s*\n", data.strip())
+        for chunk in chunks:
+            row: Dict[str, str] = {}
+            for ln in chunk.splitlines():
+                if ":" in ln:
+                    k, v = ln.split(":", 1)
+                    row[normalize_field(k)] = v.strip()
+            if row:
+                records.append(row)
+
+    return records
+
+def _load_source(source: Dict[str, Any]) -> pandas.DataFrame:
+    """Builds the report DataFrame from a query spec ({"filters", "columns"}) or from inline data ({"data"})."""
+    if "data" not in source:
+        return read_dataframe(source.get("filters"), source.get("columns"))
+    raw = source["data"]
+    if is_batch(raw):
+        #Typed record batch from rag_ag, the DataFrame is built from its columns directly
+        return decode_batch(raw)
+    # Parse the data string assuming format from retrieve_data: newline-separated key-value pairs, chunks are separated by \n\n)
+    dataFrame = pandas.DataFrame(_parse_records(raw))
+    # Ensure numeric columns
+    if 'cost' in dataFrame.columns:
+        dataFrame['cost'] = pandas.to_numeric(dataFrame['cost'], errors='coerce')
+    for col in ("approved_flag", "product", "category", "return_reason", "store_name"):
+        if col in dataFrame.columns:
+            dataFrame[col] = dataFrame[col].astype(str)
+    return dataFrame
+
+
+#The findings LLM client and the report cache are created once per worker process
+@lru_cache(maxsize=1)
+def _findings_llm() -> ChatOpenAI:
+    return ChatOpenAI(model=FINDINGS_MODEL, reasoning={"effort": "minimal"})
+
+@lru_cache(maxsize=None)
+def _report_cache(reports_dir: str) -> ReportCache:
+    return ReportCache(Path(reports_dir))
+
+#Generating the findings for a summary, or reusing the ones already generated for the same summary
+def _findings(cache: ReportCache, summary: Dict[str, Any]) -> List[str]:
+    key = summary_key(summary, FINDINGS_MODEL)
+    findings_lines = cache.get_findings(key)
+    if findings_lines is not None:
+        return findings_lines
+
+    #Now I use LLM to generate findings based on the summary provided
+    findings_prompt = (
+        "Analyze the following summary of customer return orders and generate 5-10 key findings or insights. "
+        "Focus on trends, common issues, potential business impacts, and recommendations. "
+        f"Summary: {summary}"
+    )
+    findings_response = _findings_llm().invoke(findings_prompt)
+    findings_text = _to_text(findings_response.content)
+    findings_lines = [ln.strip() for ln in findings_text.splitlines() if ln.strip()]
+    cache.store_findings(key, findings_lines)
+    return findings_lines
+
+def build_report(source: Dict[str, Any], reports_dir: str) -> Dict[str, Any]:
+    """Builds the summary, the findings and the workbook of a report (runs in a worker process).
+
+    Returns {"filename", "rows", "cached"}, where cached means an earlier workbook of the same data was reused.
+    """
+    dataFrame = _load_source(source)
+    if dataFrame.empty:
+        raise ValueError("No return orders match the requested data, no report was generated.")
+
+    #The same rows and columns always give the same workbook, so an earlier one is returned as it is
+    cache = _report_cache(reports_dir)
+    cache_key = dataset_key(dataFrame, {"findings_model": FINDINGS_MODEL})
+    filename = cache.lookup(cache_key)
+    if filename:
+        return {"filename": filename, "rows": len(dataFrame), "cached": True}
+
+    #Formating the summary of all the data in the dataframe, all groupings come from one vectorized pass
+    summary = summarize(dataFrame)
+    findings_lines = _findings(cache, summary)
+
+    #Creating the excel file containing three sheets Raw Data, Summary and Findings
+    stem = f"return_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    filename = f"{stem}.xlsx"
+    write_workbook(Path(reports_dir) / filename, dataFrame, summary, findings_lines)
+    cache.store(cache_key, filename, source_key(source))
+    cache.evict()
+    return {"filename": filename, "rows": len(dataFrame), "cached": False}
+
+def _run_job(source: Dict[str, Any], reports_dir: str) -> Dict[str, Any]:
+    #Library exceptions do not always survive pickling, and one that fails to unpickle breaks the whole pool
+    try:
+        return build_report(source, reports_dir)
+    except Exception as e:
+        raise RuntimeError(str(e) or type(e).__name__) from None
+
+
+class ReportJobs:
+    """Queue of report jobs executed by a bounded pool of worker processes.
+
+    The CPU-heavy part of a report (loading the rows, the summary and the workbook) never runs
+    on the event loop of the service, so other requests are served while reports are built.
+    """
+
+    def __init__(self, reports_dir: Path, workers: int = REPORT_WORKERS):
+        self.reports_dir = reports_dir
+        self.workers = max(1, workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._futures: Dict[str, Future] = {}
+        #The tasks waiting on the pool, kept so close() can finish them and they are not garbage collected
+        self._waiters: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        #Fresh interpreters instead of forks, the service already runs an event loop and threads
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        #The waiters of running jobs would wait for a result that nobody collects anymore
+        waiters = list(self._waiters)
+        for task in waiters:
+            task.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    def submit(self, source: Dict[str, Any]) -> str:
+        if self._pool is None:
+            raise RuntimeError("The report worker pool is not running")
+        self._prune()
+        job_id = uuid.uuid4().hex[:12]
+        self._jobs[job_id] = {"job_id": job_id, "status": "queued", "created_at": time.time(), "finished_at": None,
+                              "filename": None, "rows": None, "cached": False, "error": None}
+        future = self._pool.submit(_run_job, source, str(self.reports_dir))
+        self._futures[job_id] = future
+        task = asyncio.get_running_loop().create_task(self._wait(job_id, future, self._pool))
+        self._waiters.add(task)
+        task.add_done_callback(self._waiters.discard)
+        return job_id
+
+    async def _wait(self, job_id: str, future: Future, pool: ProcessPoolExecutor) -> None:
+        job = self._jobs[job_id]
+        try:
+            job.update(await asyncio.wrap_future(future), status="done")
+        except BrokenProcessPool:
+            #A worker died (e.g. killed for memory), the pool cannot take new jobs until it is replaced.
+            #Every job of the broken pool fails the same way, only the first one replaces it
+            job.update(status="failed", error="The report worker stopped unexpectedly")
+            if self._pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.start()
+        except asyncio.CancelledError:
+            job.update(status="failed", error="The report job was cancelled, please request the report again")
+            job["finished_at"] = time.time()
+            self._futures.pop(job_id, None)
+            #Jobs still queued when the pool is shut down are cancelled, they would otherwise stay queued forever.
+            #When the waiting task itself was cancelled (service shutdown) the cancellation goes on to the caller
+            if not future.cancelled():
+                raise
+            return
+        except Exception as e:
+            job.update(status="failed", error=str(e))
+        job["finished_at"] = time.time()
+        self._futures.pop(job_id, None)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        future = self._futures.get(job_id)
+        if job["status"] == "queued" and future is not None and future.running():
+            job["status"] = "running"
+        return dict(job)
+
+    def _prune(self) -> None:
+        expired = time.time() - REPORT_JOB_TTL_SECONDS
+        for job_id in [j for j, job in self._jobs.items() if job["finished_at"] and job["finished_at"] < expired]:
+            del self._jobs[job_id]
@@ -0,0 +1,443 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import base64
+import hashlib
+import asyncio
+import aiosqlite
+import pandas
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from migrations import migrate, normalize_date
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#SQLite database with the return orders and the CSV file it is seeded from
+RETURNS_DB = os.getenv("RETURNS_DB", "customer-data.db")
+SEED_CSV = os.getenv("SEED_CSV", "sample.csv")
+
+#Creating a model for parsging the data from CSV
+class ReturnOrder(BaseModel):
+    order_id: str = Field(...)
+    product: str = Field(...)
+    category: str = Field(...)
+    return_reason: str = Field(...)
+    cost: float = Field(...)
+    approved_flag: str = Field(...)
+    store_name: str = Field(...)
+    date: str = Field(...)
+
+    #Every date goes into the table as YYYY-MM-DD, so date filters and the date indexes compare them correctly
+    @field_validator("date", mode="before")
+    @classmethod
+    def _normalize_date(cls, value: Any) -> str:
+        return normalize_date(value)
+
+def stored_order(row: Dict[str, Any]) -> ReturnOrder:
+    """ReturnOrder of a row that is already stored (table or seed file).
+
+    Migration 4 and the seed load keep dates they cannot read, such a row keeps its date as it is
+    instead of failing. Any other invalid field still raises ValidationError.
+    """
+    try:
+        return ReturnOrder(**row)
+    except ValidationError as e:
+        if any(err["loc"] != ("date",) for err in e.errors()):
+            raise
+        order = ReturnOrder(**{**row, "date": "1970-01-01"})
+        return order.model_copy(update={"date": str(row["date"])})
+
+#Column names as people write them in files and messages, mapped to the return_orders columns
+FIELD_SYNONYMS = {
+    "reason": "return_reason",
+    "price": "cost",
+    "approved": "approved_flag",
+    "store": "store_name",
+}
+
+#This is a function to normalize the keys from the user input to match our model fields
+def normalize_field(k: str) -> str:
+    k = k.strip().lower().replace(" ", "_").replace("-", "_")
+    return FIELD_SYNONYMS.get(k, k)
+
+#Rows per transaction of a bulk insert
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "1000"))
+
+async def insert_orders(orders: List[ReturnOrder], source: str = "insert_return") -> List[bool]:
+    """Inserts validated return orders, INSERT_BATCH_SIZE rows per transaction.
+
+    Every inserted row also gets an index_outbox entry in the same transaction, the vector
+    indexer picks them up from there. Returns for every order whether it was inserted, False
+    means its order_id already exists, in the table or earlier in the same call.
+    """
+    inserted: List[bool] = []
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        for start in range(0, len(orders), INSERT_BATCH_SIZE):
+            batch = orders[start:start + INSERT_BATCH_SIZE]
+            #Taking the write lock first, so no other writer can add one of these ids between the check and the insert
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = list({order.order_id for order in batch})
+                existing = set()
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    cursor = await conn.execute(f"SELECT order_id FROM return_orders WHERE order_id IN ({', '.join('?' * len(chunk))})", chunk)
+                    existing.update(row[0] for row in await cursor.fetchall())
+                rows = []
+                for order in batch:
+                    is_new = order.order_id not in existing
+                    inserted.append(is_new)
+                    if is_new:
+                        existing.add(order.order_id)
+                        rows.append((order.order_id, order.product, order.category, order.return_reason, order.cost,
+                                     order.approved_flag, order.store_name, order.date))
+                await conn.executemany('''
+                    INSERT INTO return_orders (order_id, product, category, return_reason, cost, approved_flag, store_name, date)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', rows)
+                now = time.time()
+                await conn.executemany(
+                    "INSERT INTO index_outbox (order_id, source, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                    [(row[0], source, now, now) for row in rows],
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    return inserted
+
+
+async def pending_outbox(limit: int) -> List[tuple]:
+    """Outbox entries that are due, as (outbox id, source, *return order columns). The order columns are None for a deleted row."""
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        cursor = await conn.execute(f'''
+            SELECT index_outbox.id, index_outbox.source, {', '.join('return_orders.' + c for c in RETURN_COLUMNS)}
+            FROM index_outbox LEFT JOIN return_orders ON return_orders.order_id = index_outbox.order_id
+            WHERE index_outbox.done_at IS NULL AND index_outbox.next_attempt_at <= ?
+            ORDER BY index_outbox.id LIMIT ?
+            ''', (time.time(), limit))
+        return await cursor.fetchall()
+
+async def complete_outbox(ids: List[int]) -> None:
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        await conn.executemany("UPDATE index_outbox SET done_at = ? WHERE id = ?", [(time.time(), i) for i in ids])
+        await conn.commit()
+
+async def retry_outbox(ids: List[int], error: str, max_delay: float = 300) -> None:
+    """Records a failed attempt, the entries are due again after an exponential backoff."""
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        await conn.executemany(
+            "UPDATE index_outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ? + MIN(?, 1 << MIN(attempts, 16)) WHERE id = ?",
+            [(error, time.time(), max_delay, i) for i in ids],
+        )
+        await conn.commit()
+
+async def outbox_stats() -> Dict[str, Any]:
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        cursor = await conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(attempts), 0), MIN(created_at) FROM index_outbox WHERE done_at IS NULL"
+        )
+        pending, max_attempts, oldest = await cursor.fetchone()
+    return {"pending": pending, "max_attempts": max_attempts, "oldest_pending_age": round(time.time() - oldest, 1) if oldest else 0.0}
+
+def _seed_date(value: Any) -> Any:
+    try:
+        return normalize_date(value)
+    except ValueError:
+        return value
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+async def setup_db() -> bool:
+    """Creates the schema and loads the seed CSV if it changed since the last load.
+
+    Runs once at service startup. Returns True when the seed file was (re)loaded.
+    """
+    #The schema itself comes from the migrations, they only run the steps this database is missing
+    await asyncio.to_thread(migrate, RETURNS_DB)
+
+    #Creating connection with the sqlite db
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        if not os.path.exists(SEED_CSV):
+            return False
+        stat = os.stat(SEED_CSV)
+        cursor = await conn.execute("SELECT sha256, mtime, size FROM seed_state WHERE source = ?", (SEED_CSV,))
+        state = await cursor.fetchone()
+
+        #Same size and mtime means the file was not touched, so we do not even read it
+        if state and state[1] == stat.st_mtime and state[2] == stat.st_size:
+            return False
+        sha256 = _file_sha256(SEED_CSV)
+        if state and state[0] == sha256:
+            await conn.execute("UPDATE seed_state SET mtime = ?, size = ? WHERE source = ?", (stat.st_mtime, stat.st_size, SEED_CSV))
+            await conn.commit()
+            return False
+
+        #Now loading our CSV file and inserting the data into the table, by converting it into list of tuples, where a tuple corresponds to a row in the table
+        #An upsert instead of INSERT OR REPLACE, the replace would delete the old row without firing the index triggers
+        dataFrame = pandas.read_csv(SEED_CSV, dtype={"order_id": str, "date": str})
+        #Dates are stored as YYYY-MM-DD, the ones we cannot read are kept as they are
+        dataFrame["date"] = dataFrame["date"].map(_seed_date)
+        data = dataFrame.to_records(index=False).tolist()
+        await conn.executemany('''
+            INSERT INTO return_orders (order_id, product, category, return_reason, cost, approved_flag, store_name, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(order_id) DO UPDATE SET product = excluded.product, category = excluded.category,
+            return_reason = excluded.return_reason, cost = excluded.cost, approved_flag = excluded.approved_flag,
+            store_name = excluded.store_name, date = excluded.date
+            ''', data)
+        await conn.execute(
+            "INSERT OR REPLACE INTO seed_state (source, sha256, mtime, size) VALUES (?, ?, ?, ?)",
+            (SEED_CSV, sha256, stat.st_mtime, stat.st_size),
+        )
+        await conn.commit()
+        print(f"Seeded {len(data)} return orders from {SEED_CSV}")
+        return True
+
+
+#Columns the agents may filter and group on, everything else is rejected before it gets near the SQL
+FILTER_COLUMNS = ("order_id", "product", "category", "return_reason", "approved_flag", "store_name")
+GROUP_EXPRESSIONS = {
+    "product": "product",
+    "category": "category",
+    "return_reason": "return_reason",
+    "approved_flag": "approved_flag",
+    "store_name": "store_name",
+    "day": "date",
+    "week": "strftime('%Y-W%W', date)",
+    "month": "strftime('%Y-%m', date)",
+}
+METRIC_EXPRESSIONS = {
+    "count": "COUNT(*)",
+    "total_cost": "ROUND(SUM(cost), 2)",
+    "avg_cost": "ROUND(AVG(cost), 2)",
+    "min_cost": "MIN(cost)",
+    "max_cost": "MAX(cost)",
+}
+
+def build_where(filters: Optional[Dict[str, Any]] = None) -> Tuple[str, List[Any]]:
+    """Turns {column: value, "date_from": ..., "date_to": ...} into a parameterized WHERE clause.
+
+    Text filters ignore case, order_id has to match exactly.
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+    for column, value in (filters or {}).items():
+        if value is None or value == "":
+            continue
+        if column == "date_from":
+            clauses.append("date >= ?")
+            params.append(normalize_date(value))
+        elif column == "date_to":
+            clauses.append("date <= ?")
+            params.append(normalize_date(value))
+        elif column == "order_id":
+            clauses.append("order_id = ?")
+            params.append(value)
+        elif column in FILTER_COLUMNS:
+            #"electronics" finds the Electronics rows, the filter indexes use the same collation
+            clauses.append(f"{column} = ? COLLATE NOCASE")
+            params.append(value)
+        else:
+            raise ValueError(f"Unknown filter '{column}'")
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+#Most groups one aggregate query returns, a year by day or product x store needs more than the default
+MAX_AGGREGATE_ROWS = 5000
+
+async def aggregate(group_by: List[str], metrics: List[str], filters: Optional[Dict[str, Any]] = None,
+                    limit: int = 100) -> Tuple[List[str], List[tuple], bool]:
+    """Runs one GROUP BY query over return_orders.
+
+    Returns the column names, the rows and whether more than limit groups matched (the rows were cut off).
+    """
+    unknown = [g for g in group_by if g not in GROUP_EXPRESSIONS] + [m for m in metrics if m not in METRIC_EXPRESSIONS]
+    if unknown:
+        raise ValueError(f"Unknown group_by or metric: {', '.join(unknown)}")
+    limit = max(1, min(limit, MAX_AGGREGATE_ROWS))
+
+    select = [f"{GROUP_EXPRESSIONS[g]} AS {g}" for g in group_by] + [f"{METRIC_EXPRESSIONS[m]} AS {m}" for m in metrics]
+    where, params = build_where(filters)
+    sql = f"SELECT {', '.join(select)} FROM return_orders{where}"
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"
+    sql += " LIMIT ?"
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        #One extra row tells whether the result was cut off
+        cursor = await conn.execute(sql, [*params, limit + 1])
+        rows = await cursor.fetchall()
+    return group_by + metrics, rows[:limit], len(rows) > limit
+
+RETURN_COLUMNS = ("order_id", "product", "category", "return_reason", "cost", "approved_flag", "store_name", "date")
+
+#Words that say what kind of lookup it is rather than what to look for
+STOP_WORDS = {
+    "a", "an", "the", "at", "in", "on", "of", "for", "and", "or", "to", "from", "with", "by", "is", "are", "was", "were",
+    "order", "orders", "id", "return", "returns", "returned", "show", "me", "find", "list", "get", "all", "any", "which",
+    "what", "that", "this", "please", "about", "there", "some", "my",
+}
+#Numbers preceded by the words "order" or "id" or by "#", or a query made of numbers only, are taken as order ids.
+#The words need boundaries, otherwise "paid 1050" or "Android 1005" would be read as order ids
+ORDER_ID_PATTERN = re.compile(r"(?:\b(?:order|id)\b|#)\s*(?:\bid\b)?\s*[:#]?\s*(\d+)", re.I)
+
+def order_ids_in(query: str) -> List[str]:
+    if re.fullmatch(r"[\d\s,#]+", query.strip()):
+        return re.findall(r"\d+", query)
+    return ORDER_ID_PATTERN.findall(query)
+
+def search_terms(query: str) -> List[str]:
+    return [w for w in re.findall(r"\w+", query.lower()) if w not in STOP_WORDS]
+
+async def fetch_orders(order_ids: List[str], filters: Optional[Dict[str, Any]] = None) -> List[tuple]:
+    """Reads the return orders with the given ids (full rows, in RETURN_COLUMNS order)."""
+    where, params = build_where(filters)
+    id_clause = f"order_id IN ({', '.join('?' * len(order_ids))})"
+    where = f"{where} AND {id_clause}" if where else f" WHERE {id_clause}"
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        cursor = await conn.execute(f"SELECT {', '.join(RETURN_COLUMNS)} FROM return_orders{where} ORDER BY order_id", [*params, *order_ids])
+        return await cursor.fetchall()
+
+async def keyword_search(terms: List[str], filters: Optional[Dict[str, Any]] = None, limit: int = 10,
+                         match_all: bool = True) -> List[tuple]:
+    """Full-text search over the keyword index, best matches (bm25) first.
+
+    With match_all every term has to appear in the row, otherwise any of them is enough.
+    """
+    if not terms:
+        return []
+    match = (" AND " if match_all else " OR ").join('"' + term.replace('"', '""') + '"' for term in terms)
+    where, params = build_where(filters)
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        cursor = await conn.execute(f'''
+            WITH hits AS (
+                SELECT rowid AS hit_rowid, bm25(return_orders_fts) AS score FROM return_orders_fts WHERE return_orders_fts MATCH ?
+            )
+            SELECT {', '.join(RETURN_COLUMNS)} FROM return_orders JOIN hits ON return_orders.rowid = hits.hit_rowid{where}
+            ORDER BY hits.score LIMIT ?
+            ''', [match, *params, limit])
+        return await cursor.fetchall()
+
+#Keyset pagination keys, order_id is always the tie breaker so every row has a unique position
+SORT_KEYS = {
+    "order_id": ("order_id",),
+    "date": ("date", "order_id"),
+}
+MAX_PAGE_SIZE = 1000
+
+def _encode_cursor(order_by: str, values: tuple) -> str:
+    raw = json.dumps([order_by, list(values)]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, list]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        order_by, values = json.loads(raw)
+        return order_by, values
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+async def fetch_page(columns: Optional[List[str]] = None, filters: Optional[Dict[str, Any]] = None, order_by: str = "order_id",
+                     limit: int = 100, cursor: Optional[str] = None) -> Tuple[List[str], List[tuple], Optional[str], int]:
+    """Reads one page of return orders with keyset pagination.
+
+    Returns the projected column names, the rows, the cursor of the next page (None on the last page)
+    and the total number of rows matching the filters.
+    """
+    columns = list(columns or RETURN_COLUMNS)
+    unknown = [c for c in columns if c not in RETURN_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown column: {', '.join(unknown)}")
+    if order_by not in SORT_KEYS:
+        raise ValueError(f"order_by must be one of: {', '.join(SORT_KEYS)}")
+    sort_keys = SORT_KEYS[order_by]
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    where, params = build_where(filters)
+    #The sort keys are selected after the projected columns, we need them to build the next cursor
+    select = columns + [key for key in sort_keys if key not in columns]
+    page_where, page_params = where, list(params)
+    if cursor:
+        cursor_order, values = _decode_cursor(cursor)
+        if cursor_order != order_by or len(values) != len(sort_keys):
+            raise ValueError("The cursor belongs to another order_by")
+        seek = f"({', '.join(sort_keys)}) > ({', '.join('?' * len(sort_keys))})"
+        page_where = f"{where} AND {seek}" if where else f" WHERE {seek}"
+        page_params += values
+
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        db_cursor = await conn.execute(f"SELECT COUNT(*) FROM return_orders{where}", params)
+        total = (await db_cursor.fetchone())[0]
+        db_cursor = await conn.execute(
+            f"SELECT {', '.join(select)} FROM return_orders{page_where} ORDER BY {', '.join(sort_keys)} LIMIT ?",
+            [*page_params, limit + 1],
+        )
+        rows = await db_cursor.fetchall()
+
+    #We read one extra row to know whether there is a next page without a second query
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = _encode_cursor(order_by, tuple(last[select.index(key)] for key in sort_keys))
+    return columns, [row[:len(columns)] for row in rows], next_cursor, total
+
+
+#A dataset spec is {"filters": {...}, "columns": [...]}, the id is derived from it so the same query always gets the same id
+def _normalize_spec(filters: Optional[Dict[str, Any]] = None, columns: Optional[List[str]] = None) -> Dict[str, Any]:
+    build_where(filters) #Validating the filters before anything gets stored
+    unknown = [c for c in (columns or []) if c not in RETURN_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown column: {', '.join(unknown)}")
+    return {
+        "filters": {k: v for k, v in sorted((filters or {}).items()) if v not in (None, "")},
+        "columns": list(columns or RETURN_COLUMNS),
+    }
+
+def _dataset_spec(filters: Optional[Dict[str, Any]], columns: Optional[List[str]]) -> Tuple[str, str]:
+    raw = json.dumps(_normalize_spec(filters, columns), sort_keys=True)
+    return "ds_" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16], raw
+
+def dataset_id_for(filters: Optional[Dict[str, Any]] = None, columns: Optional[List[str]] = None) -> str:
+    """The dataset id of a query spec, without storing it (the id is a hash of the spec)."""
+    return _dataset_spec(filters, columns)[0]
+
+async def save_dataset(filters: Optional[Dict[str, Any]] = None, columns: Optional[List[str]] = None) -> str:
+    """Stores the query spec and returns its dataset id."""
+    dataset_id, raw = _dataset_spec(filters, columns)
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        await conn.execute(
+            "INSERT OR IGNORE INTO datasets (dataset_id, spec, created_at) VALUES (?, ?, ?)",
+            (dataset_id, raw, time.time()),
+        )
+        await conn.commit()
+    return dataset_id
+
+async def load_dataset(dataset_id: str) -> Dict[str, Any]:
+    async with aiosqlite.connect(RETURNS_DB) as conn:
+        cursor = await conn.execute("SELECT spec FROM datasets WHERE dataset_id = ?", (dataset_id,))
+        row = await cursor.fetchone()
+    if not row:
+        raise ValueError(f"Unknown dataset id '{dataset_id}'")
+    return json.loads(row[0])
+
+def read_dataframe(filters: Optional[Dict[str, Any]] = None, columns: Optional[List[str]] = None) -> pandas.DataFrame:
+    """Reads the rows of a query spec straight from the database into a DataFrame (blocking, run it in a thread)."""
+    spec = _normalize_spec(filters, columns)
+    where, params = build_where(spec["filters"])
+    with closing(sqlite3.connect(RETURNS_DB)) as conn:
+        dataFrame = pandas.read_sql_query(
+            f"SELECT {', '.join(spec['columns'])} FROM return_orders{where} ORDER BY order_id", conn, params=params
+        )
+    for col in spec["columns"]:
+        if col != "cost":
+            dataFrame[col] = dataFrame[col].astype(str)
+    return dataFrame
@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class SessionGate:
+    """Runs the requests of one session one at a time and shares the result of identical ones.
+
+    Two runs on the same session would write to the same checkpoint thread at once, so every
+    run holds the lock of its session. A request identical to one that is queued or running
+    (same key) does not start a run of its own, it waits for that one and gets its answer.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self.queued = 0
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    @asynccontextmanager
+    async def lock(self, session_id: str) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._users[session_id] = self._users.get(session_id, 0) + 1
+        if lock.locked():
+            self.queued += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            #Locks of idle sessions are dropped, otherwise every session ever seen would keep one
+            self._users[session_id] -= 1
+            if not self._users[session_id]:
+                del self._users[session_id]
+                del self._locks[session_id]
+
+    def inflight(self, key: Hashable) -> Optional[asyncio.Future]:
+        """The pending result of an identical request, or None when there is none."""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    @asynccontextmanager
+    async def lead(self, session_id: str, key: Hashable) -> AsyncIterator[asyncio.Future]:
+        """Registers a run under key and holds the session lock while it runs.
+
+        The caller sets the result on the yielded future, identical requests waiting on it get the same value.
+        """
+        result = asyncio.get_running_loop().create_future()
+        self._inflight[key] = result
+        try:
+            async with self.lock(session_id):
+                yield result
+        except BaseException as e:
+            if not result.done():
+                result.set_exception(e if isinstance(e, Exception) else RuntimeError("The identical request was cancelled"))
+            raise
+        finally:
+            if not result.done():
+                result.set_exception(RuntimeError("The identical request ended without an answer"))
+            if self._inflight.get(key) is result:
+                del self._inflight[key]
+            #Nobody may be waiting on it, reading the exception keeps asyncio from logging it as never retrieved
+            result.exception()
+
+    async def run(self, session_id: str, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Returns the result of factory(), run under the session lock, or of the identical run already in flight."""
+        pending = self.inflight(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        async with self.lead(session_id, key) as result:
+            value = await factory()
+            result.set_result(value)
+            return value
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_sessions": len(self._locks),
+            "inflight": len(self._inflight),
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+        }
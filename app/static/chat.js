@@ -0,0 +1,193 @@
+const messages = document.getElementById('messages');
+const chatForm = document.getElementById('chatForm');
+const userInput = document.getElementById('userInput');
+const sendButton = document.getElementById('sendButton');
+const typingIndicator = document.getElementById('typingIndicator');
+const settingsPanel = document.getElementById('settingsPanel');
+const sessionInput = document.getElementById('session_id');
+
+// Every browser keeps its own session, the messages of one session are answered one after another
+if (sessionInput.value === 'default_session') {
+    let stored = localStorage.getItem('session_id');
+    if (!stored) {
+        stored = 'session_' + Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+        localStorage.setItem('session_id', stored);
+    }
+    sessionInput.value = stored;
+}
+
+// Auto-resize textarea
+userInput.addEventListener('input', function() {
+    this.style.height = 'auto';
+    this.style.height = Math.min(this.scrollHeight, 200) + 'px';
+});
+
+// Handle Enter key
+userInput.addEventListener('keydown', function(e) {
+    if (e.key === 'Enter' && !e.shiftKey) {
+        e.preventDefault();
+        chatForm.dispatchEvent(new Event('submit'));
+    }
+});
+
+// Toggle settings panel
+function toggleSettings() {
+    settingsPanel.classList.toggle('show');
+}
+
+// Close settings when clicking outside
+document.addEventListener('click', function(e) {
+    if (!e.target.closest('.settings-btn') && !e.target.closest('.settings-panel')) {
+        settingsPanel.classList.remove('show');
+    }
+});
+
+// Handle form submission
+chatForm.addEventListener('submit', async (e) => {
+    e.preventDefault();
+
+    const message = userInput.value.trim();
+    if (!message) return;
+
+    const model = document.getElementById('model').value;
+    const session_id = document.getElementById('session_id').value;
+
+    // Clear welcome message if it exists
+    const welcomeMsg = document.querySelector('.welcome-message');
+    if (welcomeMsg) {
+        welcomeMsg.remove();
+    }
+
+    // Add user message
+    addMessage(message, 'user');
+
+    // Clear input and disable form
+    userInput.value = '';
+    userInput.style.height = 'auto';
+    setLoading(true);
+
+    try {
+        const response = await fetch(`/proxy_run_agent_stream?model=${encodeURIComponent(model)}&user_query=${encodeURIComponent(message)}&session_id=${encodeURIComponent(session_id)}`, {
+            method: 'POST',
+            signal: AbortSignal.timeout(360000) // 6 minutes
+        });
+
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        // Reading the NDJSON events as they arrive and updating the answer in place
+        const view = addMessage('', 'assistant');
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let answer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const event = JSON.parse(line);
+                if (event.type === 'token') {
+                    answer += event.content;
+                    view.setContent(answer);
+                } else if (event.type === 'tool_start') {
+                    answer = '';
+                    view.addStep(`Running ${event.name}...`);
+                } else if (event.type === 'tool_end') {
+                    view.addStep(`Finished ${event.name}`);
+                } else if (event.type === 'final') {
+                    view.setContent(event.content);
+                } else if (event.type === 'error') {
+                    addMessage(`Error: ${event.message}`, 'error');
+                }
+            }
+        }
+
+    } catch (error) {
+        if (error.name === 'TimeoutError') {
+            addMessage('Request timed out after 6 minutes. Please try again.', 'error');
+        } else {
+            addMessage(`Error: ${error.message}`, 'error');
+        }
+    } finally {
+        setLoading(false);
+    }
+});
+
+function addMessage(content, type) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+
+    const icon = type === 'user' ?
+        '<div class="user-icon">U</div>' :
+        type === 'assistant' ?
+        '<div class="assistant-icon">AI</div>' :
+        '<div class="assistant-icon">!</div>';
+
+    const header = type === 'user' ? 'You' :
+                  type === 'assistant' ? 'AI Agent' : 'Error';
+
+    let processedContent;
+    if (type === 'assistant') {
+        // Parse markdown for assistant responses
+        processedContent = marked.parse(content);
+    } else if (type === 'error') {
+        processedContent = `<div class="error">${escapeHtml(content)}</div>`;
+    } else {
+        processedContent = escapeHtml(content);
+    }
+
+    messageDiv.innerHTML = `
+        <div class="message-header">
+            ${icon}
+            ${header}
+        </div>
+        <div class="tool-steps"></div>
+        <div class="message-content">
+            ${processedContent}
+        </div>
+    `;
+
+    messages.appendChild(messageDiv);
+    messages.scrollTop = messages.scrollHeight;
+
+    // Handle used by the streaming response to update the message as events arrive
+    const steps = messageDiv.querySelector('.tool-steps');
+    const body = messageDiv.querySelector('.message-content');
+    return {
+        setContent(text) {
+            body.innerHTML = marked.parse(text);
+            messages.scrollTop = messages.scrollHeight;
+        },
+        addStep(text) {
+            const step = document.createElement('div');
+            step.textContent = text;
+            steps.appendChild(step);
+            messages.scrollTop = messages.scrollHeight;
+        }
+    };
+}
+
+function setLoading(loading) {
+    sendButton.disabled = loading;
+    userInput.disabled = loading;
+
+    if (loading) {
+        typingIndicator.classList.add('show');
+    } else {
+        typingIndicator.classList.remove('show');
+    }
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// Focus input on load
+userInput.focus();
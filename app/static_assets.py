@@ -0,0 +1,92 @@
+import re
+import gzip
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional
+from fastapi import Request
+from fastapi.responses import Response
+
+#Brotli is optional, without it gzip is the best encoding we offer
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Hashed names change with the content, so a browser may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+#The page itself is always revalidated, an unchanged one costs a 304
+PAGE_CACHE_CONTROL = "no-cache"
+MEDIA_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+}
+#"{{chat.css}}" in the page is replaced with the hashed URL of static/chat.css
+ASSET_REFERENCE = re.compile(r"\{\{([\w./-]+)\}\}")
+
+
+class _Asset:
+    """One file held in memory with its precompressed variants and its ETag."""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.variants: Dict[str, bytes] = {"identity": body}
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.variants["br"] = compressed
+
+    def encoding_for(self, accept_encoding: str) -> str:
+        accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+class StaticAssets:
+    """The chat page and its CSS/JS, content-hashed and compressed once at startup.
+
+    Files are renamed to name.<hash>.ext and served with a one-year immutable Cache-Control,
+    the page links to them by those names. After the first visit a page load is a single
+    304 for the page, everything else comes from the browser cache.
+    """
+
+    def __init__(self, static_dir: Path, page: str = "index.html", prefix: str = "/assets"):
+        self.static_dir = static_dir
+        self.prefix = prefix
+        self.urls: Dict[str, str] = {}
+        self._assets: Dict[str, _Asset] = {}
+        for path in sorted(static_dir.rglob("*")):
+            relative = path.relative_to(static_dir).as_posix()
+            if not path.is_file() or relative == page or path.suffix not in MEDIA_TYPES:
+                continue
+            body = path.read_bytes()
+            hashed = f"{path.stem}.{hashlib.sha256(body).hexdigest()[:12]}{path.suffix}"
+            name = (path.parent.relative_to(static_dir) / hashed).as_posix()
+            self.urls[relative] = f"{prefix}/{name}"
+            self._assets[name] = _Asset(body, MEDIA_TYPES[path.suffix], IMMUTABLE_CACHE_CONTROL)
+
+        html = ASSET_REFERENCE.sub(lambda m: self.urls[m.group(1)], (static_dir / page).read_text(encoding="utf-8"))
+        self.page = _Asset(html.encode("utf-8"), MEDIA_TYPES[".html"], PAGE_CACHE_CONTROL)
+
+    def get(self, name: str) -> Optional[_Asset]:
+        return self._assets.get(name)
+
+    def response(self, request: Request, asset: _Asset) -> Response:
+        """Answers with the best encoding the client accepts, or 304 when its copy is current."""
+        headers = {"ETag": asset.etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if "*" in tags or asset.etag in tags:
+                return Response(status_code=304, headers=headers)
+        encoding = asset.encoding_for(request.headers.get("accept-encoding", ""))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)